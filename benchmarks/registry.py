@@ -0,0 +1,83 @@
+"""Measures how command latency grows with the number of managed processes.
+
+Usage: python benchmarks/registry.py [--counts 10,100,1000,10000] [--commands N]
+
+For every count, a manager is started in this process with that many (stopped)
+processes, and commands that look a single process up are sent to it over a
+persistent connection. With processes indexed by name, the latency should stay
+flat however many processes there are.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pypm import constants as const
+from pypm.manager import ProcessManager
+from pypm.process import Process
+from pypm.protocol import Connection
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+def measure(count, commands):
+    port = free_port()
+    manager = ProcessManager(port=port)
+    thread = threading.Thread(target=manager.start)
+    thread.start()
+    # * Process() echoes its directory
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(count):
+            manager.add_process(Process(f"p{i}", "sleep 60"))
+    connection = Connection("localhost", port)
+    # * Waits for the server to accept connections
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            connection.request(const.CMD_GET_PID + " p0")
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    latencies = []
+    for i in range(commands):
+        # * Alternates between a lookup and a command on a stopped process
+        # * (spread over the whole registry)
+        cmd = const.CMD_GET_PID if i % 2 == 0 else const.CMD_KILL_PROCESS
+        name = f"p{(i * 7919) % count}"
+        start = time.perf_counter()
+        connection.request(f"{cmd} {name}")
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    manager._stop = True
+    thread.join()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=str, default="10,100,1000,10000", help="Numbers of processes")
+    parser.add_argument("--commands", type=int, default=1000, help="Commands sent per count")
+    args = parser.parse_args()
+
+    for count in map(int, args.counts.split(",")):
+        latencies = measure(count, args.commands)
+        print(f"processes={count:<6} mean={sum(latencies)/len(latencies)*1e6:.0f}us "
+              f"p50={percentile(latencies, 50)*1e6:.0f}us p99={percentile(latencies, 99)*1e6:.0f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measures how long it takes to spawn many managed processes.
+
+Usage: python benchmarks/spawn.py [--children N] [--parallelism P] [--ballast MB]
+
+`--ballast` makes the manager allocate (and touch) memory first, to show how
+spawn latency behaves when the manager process is large.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pypm.lifecycle import LifecycleExecutor
+from pypm.process import Process
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--children", type=int, default=300, help="Processes spawned")
+    parser.add_argument("--parallelism", type=int, default=8, help="Concurrent spawns")
+    parser.add_argument("--ballast", type=int, default=0, help="Memory held by the manager (MB)")
+    args = parser.parse_args()
+
+    ballast = bytearray(args.ballast * 2**20)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    processes = [Process(f"p{i}", "sleep 60", env={"PYPM_INDEX": str(i)})
+                 for i in range(args.children)]
+    latencies = []
+
+    def spawn(process):
+        start = time.perf_counter()
+        process.start(True)
+        latencies.append(time.perf_counter() - start)
+
+    executor = LifecycleExecutor(args.parallelism)
+    start = time.perf_counter()
+    results = executor.run(spawn, processes)
+    total = time.perf_counter() - start
+    for process in processes:
+        if process.active:
+            process.kill()
+    executor.shutdown()
+
+    failed = sum(1 for r in results if not r.ok)
+    print(f"children={args.children} parallelism={args.parallelism} ballast={args.ballast}MB")
+    print(f"total: {total*1000:.1f}ms ({args.children/total:.0f} spawns/s), failed: {failed}")
+    print(f"latency: p50={percentile(latencies, 50)*1000:.2f}ms "
+          f"p99={percentile(latencies, 99)*1000:.2f}ms max={max(latencies)*1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 import argparse
+import datetime
+import json
 import os
+import shlex
 import socket
 import struct
 import sys
+import threading
 
 import termtables as tt
 from colorama import Fore, Style
 
 from . import constants as const
 from .process import Process
-from .units import Size
+from .protocol import Connection
+from .units import Size, Time
 
 DEBUG = os.environ.get("PYPMDEBUG")
 if DEBUG is None: DEBUG = False
@@ -26,7 +31,11 @@ commands = [
     "status",
     "list",
     "start",
-    "monit"
+    "monit",
+    "logs",
+    "history",
+    "scale",
+    "reload"
 ]
 commands.sort()
 
@@ -61,6 +70,51 @@ def get_start_parser():
                         type=int, 
                         default=30, 
                         help="Logging frequency (per minute)")
+    parser.add_argument("--sampleint", 
+                        type=float, 
+                        default=1.0, 
+                        help="Interval between resource usage samples (seconds)")
+    parser.add_argument("--logsize", 
+                        type=float, 
+                        default=10, 
+                        help="Rotate process output logs larger than this (MB)")
+    parser.add_argument("--logrotate", 
+                        type=float, 
+                        default=24, 
+                        help="Rotate process output logs older than this (hours, 0 to disable)")
+    parser.add_argument("--logbackups", 
+                        type=int, 
+                        default=5, 
+                        help="Rotated output logs to keep per process")
+    parser.add_argument("--logmaxage", 
+                        type=float, 
+                        default=0, 
+                        help="Delete rotated output logs older than this (days, 0 to disable)")
+    parser.add_argument("--logcompress", 
+                        type=str, 
+                        default="gzip", 
+                        choices=["none", "gzip", "zstd"],
+                        help="Compression of rotated output logs")
+    parser.add_argument("--recent", 
+                        type=float, 
+                        default=10, 
+                        help="Resource usage history kept in memory (minutes)")
+    parser.add_argument("--metricsport", 
+                        type=int, 
+                        default=0, 
+                        help="Serve Prometheus metrics over HTTP on this port (0 to disable)")
+    parser.add_argument("--metricshost", 
+                        type=str, 
+                        default="localhost", 
+                        help="Address the Prometheus metrics are served on")
+    parser.add_argument("--parallelism", 
+                        type=int, 
+                        default=8, 
+                        help="Processes started/stopped/restarted at the same time")
+    parser.add_argument("--shutdowntimeout", 
+                        type=float, 
+                        default=30, 
+                        help="Time processes get to exit when pypm stops, before being killed (seconds)")
     return parser
 
 def get_cmd_parser(cmd):
@@ -81,6 +135,96 @@ def get_cmd_parser(cmd):
                         help="Host")
     return parser
 
+def get_logs_parser():
+    parser = argparse.ArgumentParser(prog="python -m pypm logs")
+    parser.add_argument("name",
+                        metavar="NAME",
+                        help="Process name")
+    parser.add_argument("-f", "--follow", 
+                        action="store_true",
+                        help="Keep printing output as it is produced")
+    parser.add_argument("-n", "--lines", 
+                        type=int, 
+                        default=10, 
+                        help="Number of previous lines to print")
+    parser.add_argument("--stderr", 
+                        action="store_true",
+                        help="Print stderr instead of stdout")
+    parser.add_argument("--port", 
+                        type=int, 
+                        default=8080, 
+                        help="Network port")
+    parser.add_argument("--host", 
+                        type=str, 
+                        default="localhost", 
+                        help="Host")
+    return parser
+
+def get_history_parser():
+    parser = argparse.ArgumentParser(prog="python -m pypm history")
+    parser.add_argument("names",
+                        metavar="NAME",
+                        nargs="*",
+                        help="Process names (defaults to every logged process)")
+    parser.add_argument("-m", "--metric", 
+                        type=str, 
+                        default="cpu", 
+                        choices=["cpu", "mem"],
+                        help="Metric to show")
+    parser.add_argument("-s", "--since", 
+                        type=float, 
+                        default=60, 
+                        help="Length of the time range, ending now (minutes)")
+    parser.add_argument("-p", "--points", 
+                        type=int, 
+                        default=20, 
+                        help="Number of points")
+    parser.add_argument("--stats", 
+                        type=str, 
+                        default="min,mean,max", 
+                        help="Statistics of every point (min, max, mean, count, pNN)")
+    parser.add_argument("--port", 
+                        type=int, 
+                        default=8080, 
+                        help="Network port")
+    parser.add_argument("--host", 
+                        type=str, 
+                        default="localhost", 
+                        help="Host")
+    return parser
+
+def get_reload_parser():
+    parser = argparse.ArgumentParser(prog="python -m pypm reload",
+                                     description="Restarts the replicas of a process a batch at a time, "
+                                                 "waiting for each batch to be ready")
+    parser.add_argument("name",
+                        metavar="NAME",
+                        help="Process name")
+    parser.add_argument("-b", "--batch", 
+                        type=int, 
+                        default=1, 
+                        help="Replicas restarted at once")
+    parser.add_argument("--ready", 
+                        type=str, 
+                        default=None, 
+                        help="Readiness check (defaults to the process's own)")
+    parser.add_argument("--timeout", 
+                        type=float, 
+                        default=None, 
+                        help="Time every batch has to become ready (seconds)")
+    parser.add_argument("--keep-going", 
+                        action="store_true",
+                        help="Keep restarting the other replicas if a batch fails")
+    parser.add_argument("--port", 
+                        type=int, 
+                        default=8080, 
+                        help="Network port")
+    parser.add_argument("--host", 
+                        type=str, 
+                        default="localhost", 
+                        help="Host")
+    return parser
+
 def print_msg(text):
     """Prints the given text, coloring it based on the first word"""
     if text.startswith("Error:"):
@@ -109,8 +253,9 @@ def process_command(cmd, args, host, port):
             if len(args) < 2:
                 print_msg("Error: Not enough arguments (need at least NAME and COMMAND)")
                 return
-            if len(args) > 4:
+            if len(list(filter(lambda a: "=" not in a, args[2:]))) > 2:
                 print_msg("Error: Too many arguments")
+                return
             process_add_command(args, host, port)
         elif cmd == "start":
             if len(args) > 1:
@@ -128,7 +273,7 @@ def process_command(cmd, args, host, port):
                 return
             process_remove_command(args, host, port)
         elif cmd == "kill":
-            if len(args) != 1:
+            if len(args) > 1:
                 print_msg("Error: Invalid number of arguments")
                 return
             process_kill_command(args, host, port) 
@@ -142,6 +287,11 @@ def process_command(cmd, args, host, port):
                 print_msg("Error: Invalid number of arguments")
                 return
             process_list_command(args, host, port)
+        elif cmd == "scale":
+            if len(args) != 2:
+                print_msg("Error: Invalid number of arguments (need NAME and INSTANCES)")
+                return
+            process_scale_command(args, host, port)
         elif cmd == "monit":
             if len(args) != 0:
                 print_msg("Error: Invalid number of arguments")
@@ -168,51 +318,52 @@ def process_monit_command(args, host, port):
         
 def process_status_command(args, host, port):
     """Prints the status table for a given process/list of processes"""
-    mem = process_mem_command(args, host, port)
-    if mem is None:
+    snapshot = process_snapshot_command(args, host, port)
+    if snapshot is None:
         return
-    if len(mem) == 0:
+    if len(snapshot) == 0:
         print_msg("Warning: There are no processes being managed")
         return
-    cpu = process_cpu_command(args, host, port)
-    if cpu is None:
-        return
-    pid = process_pid_command(args, host, port)
-    if pid is None:
-        return
-    uptime = process_uptime_command(args, host, port)
-    if uptime is None:
-        return
         
     lines = []
-    for name in mem:
-        memory = mem[name]
-        if name in pid:
-            active = f"{Fore.GREEN}active{Style.RESET_ALL}"
-            p = pid[name]
-            if p == -1:
-                p = "N/A"
-                active = f"{Fore.RED}stopped{Style.RESET_ALL}"
-        else:
+    for proc in snapshot:
+        if proc["pid"] == -1:
             p = "N/A"
-            active = "N/A"
-        if name in cpu:
-            c = str(cpu[name])+"%"
         else:
-            c = "N/A"
-        if name in uptime:
-            up = uptime[name]
-        else:
-            up = "N/A"
+            p = proc["pid"]
+        state_color = {"active": Fore.GREEN, "restarting": Fore.YELLOW}.get(proc["state"], Fore.RED)
+        active = f"{state_color}{proc['state']}{Style.RESET_ALL}"
+        memory = Size(proc["vms"])
+        c = str(proc["cpu"])+"%"
+        up = Time(datetime.timedelta(seconds=proc["uptime"]))
+        name = proc["name"]
+        if proc["instances"] > 1:
+            name += f" ({len(proc['pids'])}/{proc['instances']})"
+        
+        cpus = proc["cpus"] if proc["cpus"] is not None else "any"
+        restarts = str(proc["restarts"])
+        if proc["exit_code"] is not None:
+            restarts += f" (exit {proc['exit_code']})"
         
-        lines.append([name, p, memory, c, up, active])
+        lines.append([name, p, memory, c, up, cpus, restarts, active])
         
-    header = ["Name", "PID", "Mem.", "CPU", "Uptime", "Status"]
+    header = ["Name", "PID", "Mem.", "CPU", "Uptime", "CPUs", "Restarts", "Status"]
     table = tt.to_string(
         lines,
         header=list(map(lambda c: color(c, Fore.CYAN), header)),
     )
     print(table)
+    
+def process_snapshot_command(args, host, port, lines=0):
+    """Gets the state and resource usage of a specific process/list of processes"""
+    if lines > 0:
+        args = ["--lines", str(lines)] + args
+    resp = send_command(const.CMD_SNAPSHOT, args, host, port)
+    if isdata(resp):
+        return json.loads(resp[1:].decode("utf-8"))
+    else:
+        print_msg(resp[1:].decode())
+        return None
         
 def process_list_command(args, host, port):
     """List all managed processes"""
@@ -314,6 +465,74 @@ def process_stderr_command(args, host, port):
     else:
         print_msg(resp[1:].decode())
         
+def process_logs_command(name, follow, lines, stderr, host, port):
+    """Prints the latest output of a process, optionally following it"""
+    stream = "stderr" if stderr else "stdout"
+    if not follow:
+        snapshot = process_snapshot_command([name], host, port, lines=lines)
+        if snapshot is not None and lines > 0:
+            for line in snapshot[0][stream]:
+                print(line)
+        return
+    
+    # * Following takes over the connection, so it can't go through the
+    # * shared framed connection
+    args = [const.CMD_FOLLOW, name, "--lines", str(lines)]
+    if stderr:
+        args.append("--stderr")
+    sock = socket.create_connection((host, port))
+    try:
+        sock.sendall(' '.join(args).encode("utf-8"))
+        data = sock.recv(65536)
+        if data == b"":
+            return
+        if not isdata(data):
+            print_msg(data[1:].decode())
+            return
+        sys.stdout.buffer.write(data[1:])
+        sys.stdout.flush()
+        while True:
+            data = sock.recv(65536)
+            if data == b"":
+                break
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        
+def process_history_command(names, metric, since, points, stats, host, port):
+    """Prints the downsampled CPU or memory usage history of processes"""
+    args = [metric, "--start", str(-since*60), "--points", str(points), "--stats", stats] + names
+    resp = send_command(const.CMD_HISTORY, args, host, port)
+    if not isdata(resp):
+        print_msg(resp[1:].decode())
+        return
+    history = json.loads(resp[1:].decode("utf-8"))
+    stats = stats.split(",")
+    for name, series in history.items():
+        print(color(name, Fore.CYAN))
+        if len(series["times"]) == 0:
+            print_msg("Warning: No data in this time range")
+            continue
+        lines = []
+        for i, t in enumerate(series["times"]):
+            line = [datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")]
+            for stat in stats:
+                value = series[stat][i]
+                if stat == "count":
+                    line.append(value)
+                elif metric == "mem":
+                    line.append(Size(value))
+                else:
+                    line.append(f"{value:.1f}%")
+            lines.append(line)
+        print(tt.to_string(
+            lines,
+            header=list(map(lambda c: color(c, Fore.CYAN), ["Time"] + stats)),
+        ))
+        
 def process_stop_command(args, host, port):
     """Closes the pypm server running on the given host"""
     resp = send_command(const.CMD_STOP, args, host, port)
@@ -322,14 +541,34 @@ def process_stop_command(args, host, port):
 def process_add_command(args, host, port):
     """Adds a new process to be managed"""
     name, command = args[:2]
-    log_cpu = args[2] if len(args) >= 3 else "False"
-    log_freq = args[3] if len(args) == 4 else "False"
+    # * Anything of the form key=value after NAME and COMMAND is an option
+    options = [a for a in args[2:] if "=" in a]
+    args = [a for a in args[2:] if "=" not in a]
+    log_cpu = args[0] if len(args) >= 1 else "False"
+    log_freq = args[1] if len(args) == 2 else "False"
     dir_ = '"'+os.path.abspath(os.curdir)+'"'
     resp = send_command(const.CMD_ADD_PROCESS, 
-                        [name, command, log_cpu, log_freq, dir_], 
+                        [name, command, log_cpu, log_freq, dir_] + options, 
                         host, port)
     print_msg(resp[1:].decode())
         
+def process_scale_command(args, host, port):
+    """Changes the number of instances of a process"""
+    resp = send_command(const.CMD_SCALE, args, host, port)
+    print_msg(resp[1:].decode())
+        
+def process_reload_command(name, batch, ready, timeout, keep_going, host, port):
+    """Restarts the replicas of a process without stopping all of them at once"""
+    args = [name, "--batch", str(batch)]
+    if ready is not None:
+        args += ["--ready", shlex.quote(ready)]
+    if timeout is not None:
+        args += ["--timeout", str(timeout)]
+    if keep_going:
+        args.append("--keep-going")
+    resp = send_command(const.CMD_RELOAD, args, host, port)
+    print_msg(resp[1:].decode())
+        
 def process_restart_command(args, host, port):
     """Restarts a given process/list of processes"""
     resp = send_command(const.CMD_RESTART_PROCESS, args, host, port)
@@ -350,27 +589,30 @@ def process_remove_command(args, host, port):
     resp = send_command(const.CMD_REMOVE_PROCESS, args, host, port)
     print_msg(resp[1:].decode())
 
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(host, port):
+    """Returns the persistent connection to the given host, creating it if needed"""
+    with _connections_lock:
+        if (host, port) not in _connections:
+            _connections[(host, port)] = Connection(host, port)
+        return _connections[(host, port)]
+
 def send_command(cmd, args, host, port):
     string = ' '.join([cmd]+args)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((host, port))
-    sock.sendall(string.encode("utf-8"))
-    resp = b""
-    while True:
-        data = sock.recv(2048)
-        if data == b"":
-            break
-        resp += data
-        if len(data) < 2048:
-            break
-    sock.close()
-    return resp
+    return get_connection(host, port).request(string)
+
+def send_commands(commands, host, port):
+    """Pipelines several (cmd, args) pairs over one connection"""
+    strings = [' '.join([cmd]+args) for cmd, args in commands]
+    return get_connection(host, port).pipeline(strings)
     
 if __name__ == "__main__":
     import subprocess
     import sys
     
-    from .pypm import main
+    from .pypm import main_from_args
     
     
     if len(sys.argv) >= 2:
@@ -391,7 +633,7 @@ if __name__ == "__main__":
         # ! where it was called from
         if DEBUG:
             try:
-                main(args.port, args.logdir, args.logfreq)
+                main_from_args(args)
             except socket.error:
                 print_msg("Error: this port is already in use")
                 quit()
@@ -420,13 +662,48 @@ if __name__ == "__main__":
                 
             pid = subprocess.Popen([sys.executable, 
                                     "-m", 
-                                    "pypm.pypm", 
-                                    str(args.port), 
-                                    str(args.logdir), 
-                                    str(args.logfreq)],
+                                    "pypm.pypm"] + sys.argv[1:],
                     **kwargs).pid
             print_msg(f"Started process manager on port {args.port} with the PID {pid}")
         
+    elif cmd == "logs":
+        args, _ = get_logs_parser().parse_known_args()
+        try:
+            process_logs_command(args.name, 
+                                 args.follow, 
+                                 args.lines, 
+                                 args.stderr, 
+                                 args.host, 
+                                 args.port)
+        except ConnectionRefusedError:
+            print_msg("Error: pypm is not running")
+        
+    elif cmd == "reload":
+        args, _ = get_reload_parser().parse_known_args()
+        try:
+            process_reload_command(args.name, 
+                                   args.batch, 
+                                   args.ready, 
+                                   args.timeout, 
+                                   args.keep_going, 
+                                   args.host, 
+                                   args.port)
+        except ConnectionRefusedError:
+            print_msg("Error: pypm is not running")
+        
+    elif cmd == "history":
+        args, _ = get_history_parser().parse_known_args()
+        try:
+            process_history_command(args.names, 
+                                    args.metric, 
+                                    args.since, 
+                                    args.points, 
+                                    args.stats, 
+                                    args.host, 
+                                    args.port)
+        except ConnectionRefusedError:
+            print_msg("Error: pypm is not running")
+        
     elif cmd in commands:
         argparser = get_cmd_parser(cmd)
         args, _ = argparser.parse_known_args()
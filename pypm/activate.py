@@ -0,0 +1,36 @@
+"""Exec shim handing pre-bound listening sockets to a command, the way systemd's
+socket activation does.
+
+Usage: python activate.py FD[,FD...] COMMAND [ARGS...]
+
+The inherited file descriptors are moved to 3, 4, ... and LISTEN_FDS and
+LISTEN_PID are set before the command replaces the shim. This has to happen in
+the child itself, since LISTEN_PID is only known once it is forked, and it
+can't be done by the manager in a `preexec_fn` without losing vfork spawning.
+
+The script only depends on the standard library, so that it can be run with
+`python -S` by path, which keeps its startup short.
+"""
+
+import fcntl
+import os
+import sys
+
+
+def main():
+    fds = [int(fd) for fd in sys.argv[1].split(",")]
+    args = sys.argv[2:]
+    # * Copies above the target range first, so no descriptor is
+    # * overwritten before it is moved
+    copies = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3 + len(fds)) for fd in fds]
+    for fd in fds:
+        os.close(fd)
+    for i, fd in enumerate(copies):
+        os.dup2(fd, 3 + i)
+        os.close(fd)
+    os.environ["LISTEN_FDS"] = str(len(fds))
+    os.environ["LISTEN_PID"] = str(os.getpid())
+    os.execvp(args[0], args)
+
+if __name__ == "__main__":
+    main()
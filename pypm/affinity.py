@@ -0,0 +1,145 @@
+import collections
+import glob
+import logging
+import os
+import threading
+
+import psutil
+
+SPREAD = "spread"
+PACK = "pack"
+
+
+def parse_cpulist(text):
+    """Parses a CPU list such as "0-3,8,10-11" into a sorted list of CPU IDs"""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not first.isdigit() or (sep and not last.isdigit()):
+            raise ValueError(f"Invalid CPU list '{text}'")
+        cpus.update(range(int(first), int(last if sep else first) + 1))
+    return sorted(cpus)
+
+def format_cpulist(cpus):
+    """The inverse of `parse_cpulist`"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def available_cpus():
+    """CPUs the manager itself may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        return list(range(os.cpu_count() or 1))
+
+def numa_nodes():
+    """Returns the CPUs available to the manager grouped by NUMA node.
+
+    Read from sysfs on Linux; elsewhere, all CPUs are considered a single node.
+
+    Returns:
+        list: A list of CPU IDs per node (nodes without available CPUs are left out)
+    """
+
+    allowed = set(available_cpus())
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        try:
+            with open(path) as file:
+                cpus = [c for c in parse_cpulist(file.read()) if c in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [sorted(allowed)]
+    return nodes
+
+def parse_affinity(spec):
+    """Parses a placement policy: "spread", "pack" or an explicit CPU list"""
+    if spec in (SPREAD, PACK):
+        return spec
+    cpus = parse_cpulist(spec)
+    if not cpus:
+        raise ValueError("Empty CPU list")
+    unknown = set(cpus) - set(available_cpus())
+    if unknown:
+        raise ValueError(f"CPUs {format_cpulist(unknown)} aren't available")
+    return cpus
+
+def set_affinity(pid, cpus):
+    """Pins a running process to the given CPUs"""
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, cpus)
+        else:
+            psutil.Process(pid).cpu_affinity(list(cpus))
+    except (ProcessLookupError, psutil.NoSuchProcess):
+        pass
+    except (AttributeError, OSError, psutil.Error):
+        logging.warning(f"Couldn't set the CPU affinity of process {pid}")
+
+
+class Placer:
+    def __init__(self, nodes=None):
+        """Chooses the CPUs of replicas, balancing them across NUMA nodes.
+
+        Placement only looks at the CPUs of the replicas that are currently
+        running, so nothing has to be released when they stop. With the
+        "spread" policy, a process's replicas go to the node where it has the
+        fewest replicas (then the least loaded one); with "pack", they all go
+        to the node of its first replica. Either way each replica is pinned to
+        the least loaded CPU of its node.
+
+        Args:
+            nodes (list, optional): CPU IDs per node. Defaults to `numa_nodes()`.
+        """
+
+        self.nodes = nodes if nodes is not None else numa_nodes()
+        self._node_of = {cpu: i for i, cpus in enumerate(self.nodes) for cpu in cpus}
+        self._lock = threading.Lock()
+
+    def place(self, process, replica, processes):
+        """Pins a freshly spawned replica according to its process's policy.
+
+        Args:
+            process (Process): The process, with an `affinity` policy
+            replica (Replica): The replica, which gets its `cpus` set
+            processes (iterable): Every managed process, to know the current load
+        """
+
+        with self._lock:
+            replica.cpus = self._choose(process, processes)
+            set_affinity(replica.pid, replica.cpus)
+
+    def _choose(self, process, processes):
+        if process.affinity not in (SPREAD, PACK):
+            return list(process.affinity)
+        load = collections.Counter()
+        siblings = collections.Counter()
+        for p in processes:
+            for r in p.replicas:
+                if not r.active or not r.cpus:
+                    continue
+                for cpu in r.cpus:
+                    load[cpu] += 1 / len(r.cpus)
+                    if p is process and cpu in self._node_of:
+                        siblings[self._node_of[cpu]] += 1 / len(r.cpus)
+        nodes = range(len(self.nodes))
+
+        def node_load(n):
+            return sum(load[c] for c in self.nodes[n]) / len(self.nodes[n])
+        if process.affinity == PACK and siblings:
+            node = max(nodes, key=lambda n: (siblings[n], -n))
+        else:
+            node = min(nodes, key=lambda n: (siblings[n] / len(self.nodes[n]), node_load(n), n))
+        return [min(self.nodes[node], key=lambda c: (load[c], c))]
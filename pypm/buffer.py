@@ -0,0 +1,103 @@
+import collections
+import threading
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        """A fixed-capacity byte buffer that keeps the most recent data written to it.
+
+        Appending only copies the new data into place, and reads return
+        memoryviews of the underlying storage (at most two, when the data
+        wraps around) instead of copies. Since a later append overwrites the
+        storage those views point to, they must only be used while holding
+        `lock`.
+
+        The offsets of line starts are tracked as data is appended, so the
+        last N lines can be found without scanning the buffer.
+
+        Args:
+            capacity (int): Maximum number of bytes kept
+        """
+
+        self.capacity = capacity
+        self.lock = threading.RLock()
+        self._data = bytearray(capacity)
+        self._view = memoryview(self._data)
+        self._end = 0
+        self._lines = collections.deque()
+
+    @property
+    def start(self):
+        """Absolute offset of the oldest byte still in the buffer"""
+        return max(0, self._end - self.capacity)
+
+    @property
+    def end(self):
+        """Absolute offset right after the newest byte (total bytes ever written)"""
+        return self._end
+
+    def __len__(self):
+        return self._end - self.start
+
+    def append(self, data):
+        with self.lock:
+            offset = self._end
+            index = data.find(b"\n")
+            while index != -1:
+                self._lines.append(offset + index + 1)
+                index = data.find(b"\n", index + 1)
+            self._end += len(data)
+            data = memoryview(data)
+            if len(data) > self.capacity:
+                data = data[-self.capacity:]
+                offset = self._end - self.capacity
+            pos = offset % self.capacity
+            first = min(len(data), self.capacity - pos)
+            self._view[pos:pos+first] = data[:first]
+            self._view[:len(data)-first] = data[first:]
+            start = self.start
+            while self._lines and self._lines[0] < start:
+                self._lines.popleft()
+
+    def range(self, begin, end):
+        """Returns the data between two absolute offsets.
+
+        Offsets are clamped to what is still in the buffer.
+
+        Returns:
+            tuple: memoryviews that, concatenated, hold the data
+        """
+
+        with self.lock:
+            begin = max(begin, self.start)
+            end = min(end, self._end)
+            if begin >= end:
+                return ()
+            first, last = begin % self.capacity, end % self.capacity
+            if first < last:
+                return (self._view[first:last],)
+            return (self._view[first:], self._view[:last])
+
+    def tail(self, size=None):
+        """Returns the last `size` bytes (everything by default)"""
+        if size is None:
+            size = self.capacity
+        return self.range(self._end - size, self._end)
+
+    def tail_lines(self, lines):
+        """Returns the last `lines` lines, as in `range`"""
+        with self.lock:
+            if lines <= 0:
+                return ()
+            # * If the data ends with a newline the last line start is empty
+            skip = 1 if self._lines and self._lines[-1] == self._end else 0
+            if lines + skip <= len(self._lines):
+                begin = self._lines[-(lines + skip)]
+            else:
+                begin = self.start
+            return self.range(begin, self._end)
+
+    def getvalue(self):
+        """Returns a copy of the whole buffer"""
+        with self.lock:
+            return b"".join(self.tail())
@@ -0,0 +1,262 @@
+import collections
+import logging
+import os
+import selectors
+import socket
+import sys
+import threading
+
+from . import constants as const
+
+
+class Follower:
+    def __init__(self, sock, max_pending=2**20):
+        """A client that receives a process's output as it is produced.
+
+        The client gets a single `DATA_CODE` followed by the raw output. Every
+        chunk of output is handed to all followers as the same object, they
+        only queue references to it. Sends never block: whatever the socket
+        doesn't take right away is queued and sent by the `OutputReader` once
+        the socket becomes writable. A follower that falls more than
+        `max_pending` bytes behind is disconnected.
+
+        Args:
+            sock (socket.socket): The client connection
+            max_pending (int, optional): Maximum bytes queued. Defaults to 1MB.
+        """
+
+        self.sock = sock
+        self.max_pending = max_pending
+        self.closed = False
+        self.reader = None
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._started = False
+        self._lock = threading.Lock()
+        sock.setblocking(False)
+
+    def push(self, data):
+        if self.closed or (self._started and len(data) == 0):
+            return
+        if not self._started:
+            parts = [const.DATA_CODE, data]
+        else:
+            parts = [data]
+        self._started = True
+        with self._lock:
+            was_empty = len(self._pending) == 0
+            for part in parts:
+                if len(part) > 0:
+                    self._pending.append(memoryview(part).cast("B"))
+                    self._pending_size += len(part)
+            if self._pending_size > self.max_pending:
+                self.close()
+                return
+            if was_empty and not self._flush() and self.reader is not None:
+                self.reader.want_write(self)
+
+    def flush(self):
+        """Sends as much queued data as possible, returns True if nothing is left"""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        try:
+            while self._pending:
+                if hasattr(self.sock, "sendmsg"):
+                    sent = self.sock.sendmsg(list(self._pending)[:64])
+                else:
+                    sent = self.sock.send(self._pending[0])
+                self._pending_size -= sent
+                while sent > 0 and sent >= len(self._pending[0]):
+                    sent -= len(self._pending.popleft())
+                if sent > 0:
+                    self._pending[0] = self._pending[0][sent:]
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            self.close()
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.reader is not None:
+                self.reader.remove_follower(self)
+            else:
+                self.sock.close()
+
+
+class OutputReader:
+    def __init__(self, chunk_size=65536):
+        """Reads the output pipes of every managed process from a single thread.
+
+        Data is handed to each stream's callback as soon as it arrives. At most
+        `chunk_size` bytes are read from a pipe per wake-up, so one chatty
+        process can't starve the others. Callbacks run on the reader thread:
+        if they fall behind, the pipes fill up and the children block on write
+        instead of the manager buffering without bound.
+
+        The same thread also writes to the `Follower`s of the processes'
+        output whenever their sockets can't take it right away.
+
+        Args:
+            chunk_size (int, optional): Maximum bytes read per pipe per wake-up.
+                Defaults to 65536.
+        """
+
+        self.chunk_size = chunk_size
+        self._selector = None
+        self._followers = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = None, None
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        self._stop = False
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="pypm-reader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._wake()
+            self._thread.join()
+            self._thread = None
+
+    def register(self, stream, callback):
+        """Starts reading a pipe.
+
+        Args:
+            stream (file): The read end of the pipe, closed once it reaches EOF
+            callback (callable): Called with every chunk of data read, and
+                with b"" once the pipe is closed
+        """
+
+        if sys.platform == "win32":
+            # * select() doesn't support pipes on Windows, every stream gets
+            # * its own blocking reader thread instead
+            thread = threading.Thread(target=self._read_blocking, args=(stream, callback))
+            thread.daemon = True
+            thread.start()
+            return
+        os.set_blocking(stream.fileno(), False)
+        self._queue("pipe", stream, callback)
+
+    def add_follower(self, follower):
+        follower.reader = self
+        self._queue("follow", follower)
+
+    def want_write(self, follower):
+        """Sends the follower's queued data as soon as its socket is writable"""
+        self._queue("write", follower)
+
+    def remove_follower(self, follower):
+        self._queue("close", follower)
+
+    def _queue(self, *op):
+        with self._lock:
+            self._pending.append(op)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\x00")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _read_blocking(self, stream, callback):
+        with stream:
+            while not self._stop:
+                data = stream.read1(self.chunk_size)
+                callback(data)
+                if data == b"":
+                    break
+
+    def _run(self):
+        try:
+            while not self._stop:
+                for key, events in self._selector.select():
+                    if key.fileobj is self._wake_r:
+                        self._process_pending()
+                    elif isinstance(key.data, Follower):
+                        self._serve_follower(key.data, events)
+                    else:
+                        self._read(key.fileobj, key.data)
+        finally:
+            for key in list(self._selector.get_map().values()):
+                key.fileobj.close()
+            self._selector.close()
+            self._wake_w.close()
+
+    def _process_pending(self):
+        try:
+            while self._wake_r.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for op, *args in pending:
+            if op == "pipe":
+                stream, callback = args
+                self._selector.register(stream, selectors.EVENT_READ, callback)
+                continue
+            follower = args[0]
+            registered = follower in self._followers
+            if op == "close" or follower.closed:
+                if registered:
+                    self._unregister_follower(follower)
+                follower.sock.close()
+            elif op == "follow":
+                # * Reading from a follower only serves to detect disconnects
+                self._selector.register(follower.sock, selectors.EVENT_READ, follower)
+                self._followers.add(follower)
+            elif op == "write" and registered:
+                self._selector.modify(follower.sock,
+                                      selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                      follower)
+
+    def _serve_follower(self, follower, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = follower.sock.recv(4096)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b""
+            if data == b"":
+                follower.closed = True
+                self._unregister_follower(follower)
+                follower.sock.close()
+                return
+        if events & selectors.EVENT_WRITE and follower.flush():
+            if not follower.closed:
+                self._selector.modify(follower.sock, selectors.EVENT_READ, follower)
+
+    def _unregister_follower(self, follower):
+        self._selector.unregister(follower.sock)
+        self._followers.discard(follower)
+
+    def _read(self, stream, callback):
+        try:
+            data = os.read(stream.fileno(), self.chunk_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data == b"":
+            self._selector.unregister(stream)
+            stream.close()
+        try:
+            callback(data)
+        except Exception:
+            logging.exception("Couldn't process output")
@@ -12,6 +12,13 @@ CMD_GET_PID = "procpid"
 CMD_GET_UPTIME = "procupt"
 CMD_GET_STDOUT = "procstdout"
 CMD_GET_STDERR = "porcstderr"
+CMD_SNAPSHOT = "snapshot"
+CMD_FOLLOW = "follow"
+CMD_HISTORY = "history"
+CMD_RECENT = "recent"
+CMD_SCALE = "scale"
+CMD_RELOAD = "reloadproc"
 
 DATA_CODE = b"\x00"
-MSG_CODE = b"\x01"
\ No newline at end of file
+MSG_CODE = b"\x01"
+FRAME_CODE = b"\x02"
@@ -0,0 +1,146 @@
+import math
+
+STATS = ("min", "max", "mean", "count")
+
+
+def choose_width(widths, start, end, points, oversample=4):
+    """Picks the resolution a time range should be read at.
+
+    Args:
+        widths (list): Available resolutions (sampling period, rollup widths), in seconds
+        start (float): Start of the range (UNIX time)
+        end (float): End of the range (UNIX time)
+        points (int): Number of points that will be returned
+        oversample (int, optional): How many rows may be read per returned
+            point. Defaults to 4.
+
+    Returns:
+        float: The finest resolution that doesn't read more than
+            `points * oversample` rows, or the coarsest one
+    """
+
+    widths = sorted(widths)
+    for width in widths:
+        if (end - start) / width <= points * oversample:
+            return width
+    return widths[-1]
+
+def percentile(values, q):
+    """Returns the q-th percentile of sorted values (linear interpolation)"""
+    if len(values) == 0:
+        return math.nan
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+def _check_stat(stat):
+    if stat in STATS:
+        return
+    if stat.startswith("p"):
+        try:
+            if 0 <= float(stat[1:]) <= 100:
+                return
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown statistic '{stat}'")
+
+def aggregate(rows, start, end, buckets, stats=("mean",)):
+    """Aggregates rows into equal time buckets.
+
+    Raw samples are passed as (time, 1, value, value, value) and rollup
+    records as they are stored, so both go through the same code. Percentiles
+    ("p50", "p99", ...) are exact for raw samples; for rollups they are
+    computed over the bucket means.
+
+    Args:
+        rows (iterable): (time, count, min, max, mean) tuples
+        start (float): Start of the range (UNIX time)
+        end (float): End of the range (UNIX time), exclusive
+        buckets (int): Number of buckets
+        stats (tuple, optional): Statistics to compute among "min", "max",
+            "mean", "count" and "pNN". Defaults to ("mean",).
+
+    Returns:
+        tuple: The start time of every non-empty bucket, and a dict mapping
+            each statistic to its values
+    """
+
+    for stat in stats:
+        _check_stat(stat)
+    percentiles = [s for s in stats if s not in STATS]
+    width = (end - start) / buckets if end > start else 1
+    acc = {}
+    for t, count, low, high, mean in rows:
+        if t < start or t >= end:
+            continue
+        i = min(int((t - start) / width), buckets - 1)
+        a = acc.get(i)
+        if a is None:
+            a = acc[i] = [0, low, high, 0.0, []]
+        a[0] += count
+        if low < a[1]:
+            a[1] = low
+        if high > a[2]:
+            a[2] = high
+        a[3] += mean * count
+        if percentiles:
+            a[4].append(mean)
+    times = []
+    columns = {stat: [] for stat in stats}
+    for i in sorted(acc):
+        count, low, high, total, values = acc[i]
+        times.append(start + i * width)
+        values.sort()
+        for stat in stats:
+            if stat == "min":
+                columns[stat].append(low)
+            elif stat == "max":
+                columns[stat].append(high)
+            elif stat == "mean":
+                columns[stat].append(total / count)
+            elif stat == "count":
+                columns[stat].append(int(count))
+            else:
+                columns[stat].append(percentile(values, float(stat[1:])))
+    return times, columns
+
+def lttb(times, values, threshold):
+    """Decimates a series with the Largest-Triangle-Three-Buckets algorithm.
+
+    Keeps the points that best preserve the shape of the series when it is
+    plotted, including the first and last ones.
+
+    Returns:
+        tuple: The times and values of at most `threshold` points
+    """
+
+    n = len(values)
+    if threshold >= n:
+        return list(times), list(values)
+    if threshold < 3:
+        # * Too few points for a triangle: keep the ends
+        keep = [0, n - 1][:max(threshold, 0)]
+        return [times[i] for i in keep], [values[i] for i in keep]
+    out_t, out_v = [times[0]], [values[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # * Average of the next bucket, the third point of the triangle
+        first = int((i + 1) * every) + 1
+        last = min(int((i + 2) * every) + 1, n)
+        avg_t = sum(times[first:last]) / (last - first)
+        avg_v = sum(values[first:last]) / (last - first)
+        # * Point of the current bucket that makes the largest triangle
+        best, best_area = -1, -1
+        for j in range(int(i * every) + 1, first):
+            area = abs((times[a] - avg_t) * (values[j] - values[a]) -
+                       (times[a] - times[j]) * (avg_v - values[a]))
+            if area > best_area:
+                best, best_area = j, area
+        out_t.append(times[best])
+        out_v.append(values[best])
+        a = best
+    out_t.append(times[-1])
+    out_v.append(values[-1])
+    return out_t, out_v
@@ -0,0 +1,111 @@
+import http.server
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+STATES = ("active", "restarting", "crashed", "stopped")
+
+# * (name, type, help) of every exported metric
+METRICS = (
+    ("pypm_process_cpu_percent", "gauge", "CPU usage, as a percentage of the whole machine"),
+    ("pypm_process_resident_memory_bytes", "gauge", "Resident memory size"),
+    ("pypm_process_virtual_memory_bytes", "gauge", "Virtual memory size"),
+    ("pypm_process_uptime_seconds", "gauge", "Time since the process was started"),
+    ("pypm_process_restarts_total", "counter", "Times the process was restarted"),
+    ("pypm_process_state", "gauge", "Current state of the process"),
+    ("pypm_process_instances", "gauge", "Running replicas of the process"),
+)
+
+
+def escape(value):
+    """Escapes a label value"""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExporter:
+    def __init__(self, processes, sampler, port, host="localhost"):
+        """Serves the resource usage of the managed processes over HTTP, in the
+        Prometheus text exposition format, at `/metrics`.
+
+        The page is rendered from the sampler's latest samples and cached until
+        the sampler's next pass, so scrapes never cause extra psutil calls
+        and the page is rendered at most once per sampling interval, no matter
+        how often it is scraped.
+
+        Args:
+            processes (iterable): The managed processes
+            sampler (Sampler): The sampler of their resource usage
+            port (int): Network port
+            host (str, optional): Address to listen on. Defaults to "localhost".
+        """
+
+        self.port = port
+        self.host = host
+        self._processes = processes
+        self._sampler = sampler
+        self._page = b""
+        self._rendered = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                page = exporter.page()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="pypm-exporter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def page(self):
+        """Returns the rendered page, rendering it again if it is older than a sampling interval"""
+        with self._lock:
+            if time.time() - self._rendered >= self._sampler.interval:
+                self._page = self.render()
+                self._rendered = time.time()
+            return self._page
+
+    def render(self):
+        rows = {name: [] for name, _, _ in METRICS}
+        for process in self._processes:
+            sample = self._sampler.get(process)
+            label = f"name=\"{escape(process.name)}\""
+            rows["pypm_process_cpu_percent"].append((label, sample.cpu))
+            rows["pypm_process_resident_memory_bytes"].append((label, sample.rss))
+            rows["pypm_process_virtual_memory_bytes"].append((label, sample.vms))
+            rows["pypm_process_uptime_seconds"].append((label, process.uptime.seconds))
+            rows["pypm_process_restarts_total"].append((label, process.restarts))
+            rows["pypm_process_instances"].append((label, len(process.pids)))
+            state = process.state
+            for s in STATES:
+                rows["pypm_process_state"].append((f"{label},state=\"{s}\"", int(s == state)))
+        lines = []
+        for name, kind, description in METRICS:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label, value in rows[name]:
+                lines.append(f"{name}{{{label}}} {value}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
@@ -0,0 +1,107 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Result:
+    __slots__ = ("name", "ok", "error")
+
+    def __init__(self, name, ok, error=None):
+        """Outcome of a lifecycle operation on a process
+
+        Args:
+            name (str): Name of the process
+            ok (bool): True if the operation succeeded
+            error (str, optional): Why it failed
+        """
+
+        self.name = name
+        self.ok = ok
+        self.error = error
+
+
+class LifecycleExecutor:
+    def __init__(self, parallelism=8):
+        """Starts, stops and restarts many processes at once.
+
+        Operations run on a pool of at most `parallelism` threads, separate
+        from the command handlers, so a restart of every process neither
+        blocks other commands nor spawns an unbounded number of children at
+        the same time.
+
+        Args:
+            parallelism (int, optional): Maximum concurrent operations. Defaults to 8.
+        """
+
+        self.parallelism = parallelism
+        self._pool = ThreadPoolExecutor(max_workers=parallelism,
+                                        thread_name_prefix="pypm-lifecycle")
+
+    def run(self, operation, processes):
+        """Applies `operation` to every process concurrently and waits for all of them.
+
+        Args:
+            operation (callable): Called with a process, raises on failure
+            processes (iterable): The processes
+
+        Returns:
+            list: A `Result` per process, in the same order
+        """
+
+        processes = list(processes)
+        futures = [self._pool.submit(operation, p) for p in processes]
+        results = []
+        for process, future in zip(processes, futures):
+            try:
+                future.result()
+                results.append(Result(process.name, True))
+            except Exception as e:
+                results.append(Result(process.name, False, str(e) or type(e).__name__))
+        return results
+
+    def run_ordered(self, operation, processes):
+        """Like `run`, but each process only once all its `depends` succeeded.
+
+        A process is submitted as soon as the last of its dependencies
+        finishes, rather than in strict waves. Dependencies that aren't among
+        `processes` are ignored. Processes whose dependencies failed, or that
+        are part of a dependency cycle, fail without running.
+        """
+
+        processes = list(processes)
+        names = {p.name for p in processes}
+        remaining = {p.name: {d for d in p.depends if d in names} for p in processes}
+        by_name = {p.name: p for p in processes}
+        results = {}
+        pending = {}
+
+        def submit_ready():
+            for name in [n for n, deps in remaining.items() if not deps]:
+                del remaining[name]
+                pending[self._pool.submit(operation, by_name[name])] = name
+
+        submit_ready()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    future.result()
+                    results[name] = Result(name, True)
+                except Exception as e:
+                    results[name] = Result(name, False, str(e) or type(e).__name__)
+                failed = [name] if not results[name].ok else []
+                # * Fail everything that (transitively) depends on a failure
+                while failed:
+                    dependency = failed.pop()
+                    for n in [n for n, deps in remaining.items() if dependency in deps]:
+                        del remaining[n]
+                        results[n] = Result(n, False, f"Dependency '{dependency}' failed")
+                        failed.append(n)
+                for deps in remaining.values():
+                    deps.discard(name)
+            submit_ready()
+        for name in remaining:
+            results[name] = Result(name, False, "Dependency cycle")
+        return [results[p.name] for p in processes]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,115 @@
+import os
+import socket
+import stat
+import threading
+
+
+def parse_address(spec):
+    """Parses a listening address.
+
+    Args:
+        spec (str): "PORT", "HOST:PORT", "[IPV6]:PORT" or "unix:PATH"
+
+    Returns:
+        tuple: The socket family and address
+
+    Raises:
+        ValueError: If the address is invalid
+    """
+
+    if spec.startswith("unix:"):
+        if not spec[5:]:
+            raise ValueError("Empty socket path")
+        return socket.AF_UNIX, os.path.abspath(spec[5:])
+    host, _, port = spec.rpartition(":")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid port in '{spec}'")
+    if host.startswith("[") and host.endswith("]"):
+        return socket.AF_INET6, (host[1:-1], int(port))
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+
+class Listeners:
+    def __init__(self, backlog=socket.SOMAXCONN):
+        """Listening sockets owned by the manager on behalf of its processes.
+
+        The sockets are bound once and stay open across restarts, so
+        connections keep queuing in the kernel backlog while no child is
+        accepting them. Processes that declare the same address share the
+        same socket, which is closed once none of them needs it anymore.
+
+        Args:
+            backlog (int, optional): Listen backlog. Defaults to `socket.SOMAXCONN`.
+        """
+
+        self.backlog = backlog
+        self._sockets = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, owner, specs):
+        """Returns the listening sockets of the given addresses, binding the missing ones.
+
+        Raises:
+            ValueError: If an address is invalid
+            OSError: If an address can't be bound
+        """
+
+        addresses = [parse_address(spec) for spec in specs]
+        with self._lock:
+            self._release(owner)
+            sockets = []
+            try:
+                for address in addresses:
+                    if address not in self._sockets:
+                        self._sockets[address] = [self._bind(*address), 0]
+                    self._sockets[address][1] += 1
+                    sockets.append(self._sockets[address][0])
+            finally:
+                self._owners[owner] = addresses[:len(sockets)]
+                if len(sockets) < len(addresses):
+                    self._release(owner)
+            return sockets
+
+    def release(self, owner):
+        """Gives up the sockets of an owner, closing those nobody else uses"""
+        with self._lock:
+            self._release(owner)
+
+    def close(self):
+        with self._lock:
+            for owner in list(self._owners):
+                self._release(owner)
+
+    def _release(self, owner):
+        for address in self._owners.pop(owner, ()):
+            entry = self._sockets[address]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._sockets[address]
+                entry[0].close()
+                if address[0] == socket.AF_UNIX:
+                    self._unlink(address[1])
+
+    def _bind(self, family, address):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_UNIX:
+                self._unlink(address)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            sock.listen(self.backlog)
+        except OSError as e:
+            sock.close()
+            raise OSError(e.errno, f"Couldn't listen on {address}: {e.strerror}")
+        return sock
+
+    @staticmethod
+    def _unlink(path):
+        """Removes a stale socket file (anything else is left alone)"""
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
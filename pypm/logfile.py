@@ -0,0 +1,213 @@
+import datetime
+import glob
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+class Compressor:
+    def __init__(self):
+        """Compresses rotated log segments on a background thread"""
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pypm-compressor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the worker once every queued segment has been compressed"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, path, method, callback=None):
+        """Queues a file to be compressed (and deleted once it is).
+
+        Args:
+            path (str): The file
+            method (str): "gzip" or "zstd"
+            callback (callable, optional): Called once the file is compressed
+        """
+
+        if self._thread is None:
+            self._compress(path, method, callback)
+        else:
+            self._queue.put((path, method, callback))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self._compress(*job)
+
+    def _compress(self, path, method, callback):
+        target = path + COMPRESSIONS[method]
+        try:
+            with open(path, "rb") as src:
+                if method == "gzip":
+                    with gzip.open(target, "wb", compresslevel=6) as dst:
+                        shutil.copyfileobj(src, dst, 2**20)
+                else:
+                    with open(target, "wb") as dst:
+                        zstandard.ZstdCompressor().copy_stream(src, dst)
+            os.remove(path)
+        except FileNotFoundError:
+            # * Deleted in the meantime, there is nothing left to compress
+            pass
+        except OSError:
+            logging.exception(f"Couldn't compress '{path}'")
+        if callback is not None:
+            callback()
+
+
+class RotatingLog:
+    def __init__(self, path, max_bytes=10*2**20, interval=None, backups=5,
+                 max_age=None, compression=None, compressor=None,
+                 buffer_size=2**16):
+        """An append-only log file that is rotated by size and/or age.
+
+        Rotated segments are renamed to `path.YYYYmmdd-HHMMSS-ffffff`,
+        optionally compressed by `compressor`, and deleted once there are more
+        than `backups` of them or they are older than `max_age`. Writes go
+        through a large buffer, so call `flush` periodically.
+
+        Args:
+            path (str): Path of the live log file
+            max_bytes (int, optional): Rotate once the file grows past this size.
+                Defaults to 10MB.
+            interval (float, optional): Rotate once the file is this many seconds
+                old. Defaults to never.
+            backups (int, optional): Rotated segments to keep. Defaults to 5.
+            max_age (float, optional): Delete segments older than this many
+                seconds. Defaults to never.
+            compression (str, optional): "gzip", "zstd" or None. Defaults to None.
+            compressor (Compressor, optional): Worker compressing the segments.
+                Defaults to compressing synchronously.
+            buffer_size (int, optional): Size of the write buffer. Defaults to 64KB.
+        """
+
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression method '{compression}'")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backups = backups
+        self.max_age = max_age
+        self.compression = compression
+        self._compressor = compressor if compressor is not None else Compressor()
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        # * Segments queued for compression, which retention leaves alone
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._opened = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "ab", buffering=self._buffer_size)
+        self._size = self._file.tell()
+        if self._size > 0:
+            self._opened = os.path.getmtime(self.path)
+        else:
+            self._opened = time.time()
+
+    def write(self, data):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._size > 0 and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._size += len(data)
+
+    def flush(self):
+        """Flushes buffered data, rotating the file if it is too old"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self.interval is not None and self._size > 0:
+                if time.time() - self._opened >= self.interval:
+                    self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def rotate(self):
+        with self._lock:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        segment = f"{self.path}.{stamp}"
+        os.replace(self.path, segment)
+        self._open()
+        if self.compression is None:
+            self.enforce_retention()
+        else:
+            with self._pending_lock:
+                self._pending.add(segment)
+            self._compressor.submit(segment, self.compression, lambda: self._compressed(segment))
+
+    def _compressed(self, segment):
+        with self._pending_lock:
+            self._pending.discard(segment)
+        self.enforce_retention()
+
+    def segments(self):
+        """Returns the rotated segments, oldest first (without the ones still
+        being compressed)"""
+        with self._pending_lock:
+            pending = set(self._pending)
+        segments = []
+        for segment in glob.glob(glob.escape(self.path) + ".*"):
+            base = segment
+            if self.compression is not None and segment.endswith(COMPRESSIONS[self.compression]):
+                base = segment[:-len(COMPRESSIONS[self.compression])]
+            if base not in pending:
+                segments.append(segment)
+        return sorted(segments)
+
+    def enforce_retention(self):
+        """Deletes the segments that fall outside the retention policy"""
+        segments = self.segments()
+        expired = segments[:max(0, len(segments) - self.backups)]
+        if self.max_age is not None:
+            limit = time.time() - self.max_age
+            for segment in segments[len(expired):]:
+                try:
+                    if os.path.getmtime(segment) < limit:
+                        expired.append(segment)
+                except OSError:
+                    pass
+        for segment in expired:
+            try:
+                os.remove(segment)
+            except OSError:
+                pass
@@ -1,32 +1,116 @@
+import json
 import logging
 import os
-import select
+import selectors
 import shlex
+import signal
 import socket
 import struct
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from . import constants as const
+from .affinity import Placer, format_cpulist, parse_affinity
+from .capture import Follower, OutputReader
+from .exporter import MetricsExporter
+from .lifecycle import LifecycleExecutor, Result
+from .listeners import Listeners, parse_address
+from .logfile import COMPRESSIONS, Compressor, RotatingLog, zstandard
+from .metrics import ROLLUP_WIDTHS, MetricWriter, RollupWriter, query, rollup_path
 from .process import Process
+from .protocol import SEND_TIMEOUT, FramedConnection, FrameReply, send_parts
+from .readiness import PortOpen, parse_check, wait_ready
+from .recent import RecentMetrics
+from .registry import ProcessRegistry
+from .sampler import Sampler
+from .supervisor import POLICIES, Supervisor
 
 
 def sbool(string):
     return True if string == "True" else False
 
+def parse_options(args):
+    """Parses `key=value` command arguments into a dictionary"""
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not key:
+            raise ValueError(f"Invalid option '{arg}'")
+        options[key] = value
+    return options
+
+def parse_instances(value):
+    """Parses a number of replicas, "auto" being one per CPU"""
+    if value == "auto":
+        return os.cpu_count() or 1
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError("Number of instances must be a positive integer or 'auto'")
+    return int(value)
+
+def parse_signal(value):
+    """Parses a signal name ("TERM" or "SIGTERM") or number"""
+    try:
+        if value.isdigit():
+            return signal.Signals(int(value))
+        name = value.upper()
+        return signal.Signals[name if name.startswith("SIG") else "SIG" + name]
+    except (KeyError, ValueError):
+        raise ValueError(f"Unknown signal '{value}'")
+
+def tail_lines(buff, lines):
+    """Decodes the last `lines` lines of the given output buffer"""
+    with buff.lock:
+        data = b"".join(buff.tail_lines(lines))
+    text = data.decode("utf-8", "replace")
+    if text.endswith("\n"):
+        text = text[:-1]
+    return text.split("\n")[-lines:]
+
 
 # TODO: Add documentation
 class ProcessManager:
-    def __init__(self, port=8080, log_dir=None, log_frequency=30):
+    def __init__(self, port=8080, log_dir=None, log_frequency=30, workers=8, 
+                 sample_interval=1.0, log_max_bytes=10*2**20, log_rotate_interval=None,
+                 log_backups=5, log_max_age=None, log_compression=None, recent_window=600,
+                 metrics_port=None, metrics_host="localhost", parallelism=8, shutdown_timeout=30):
         self.port = port
+        self.shutdown_timeout = shutdown_timeout
         self.log_dir = log_dir
         self.log_frequency = log_frequency
-        self._processes = []
-        self._log_cpu = []
-        self._log_memory = []
+        self.workers = workers
+        self.log_max_bytes = log_max_bytes
+        self.log_rotate_interval = log_rotate_interval
+        self.log_backups = log_backups
+        self.log_max_age = log_max_age
+        self.log_compression = log_compression
+        if log_compression is not None and log_compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression method '{log_compression}'")
+        if log_compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package")
+        self._compressor = Compressor()
+        self._metric_writers = {}
+        self._metric_writers_lock = threading.Lock()
+        self._processes = ProcessRegistry()
+        self._sampler = Sampler(self._processes, sample_interval)
+        self._recent = RecentMetrics(recent_window, self.log_period)
+        self._exporter = None
+        if metrics_port is not None:
+            self._exporter = MetricsExporter(self._processes, self._sampler, 
+                                             metrics_port, metrics_host)
+        self._reader = OutputReader()
+        self._lifecycle = LifecycleExecutor(parallelism)
+        self._placer = None
+        self._supervisor = Supervisor(self._respawn)
+        self._listeners = Listeners()
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._server_thread = None
+        self._autostart_thread = None
+        self._server_wake = None
+        self._resumed = []
+        self._connections = set()
+        self._resumed_lock = threading.Lock()
         self._stop = False
         
     def add_process(self, process, log_cpu=False, log_memory=False):
@@ -39,24 +123,212 @@ class ProcessManager:
 
         Returns:
             bool: True if process wasn't already added
+            
+        Raises:
+            OSError: If the addresses the process listens on can't be bound
         """
         
-        if process in self._processes:
+        if not self._processes.add(process, log_cpu, log_memory):
             return False
-        self._processes.append(process)
-        if log_cpu and process not in self._log_cpu:
-            self._log_cpu.append(process)
-        if log_memory and process not in self._log_memory:
-            self._log_memory.append(process) 
+        if process.listen:
+            try:
+                process.listen_sockets = self._listeners.acquire(process.name, process.listen)
+            except OSError:
+                self._processes.remove(process)
+                raise
         return True
             
     def rem_process(self, process):
         """Removes a process"""
         self._processes.remove(process)
-        if process in self._log_cpu:
-            self._log_cpu.remove(process)
-        if process in self._log_memory:
-            self._log_memory.remove(process)
+        self._listeners.release(process.name)
+        process.listen_sockets = []
+        process.close_followers()
+        self._close_metric_writers(process.name)
+        self._recent.remove(process.name)
+        if process.logs is not None:
+            for log in process.logs:
+                log.close()
+        
+    def start_process(self, process):
+        """Starts a managed process, capturing its output"""
+        if self.log_dir is not None and process.logs is None:
+            self.assert_logdir_exists()
+            process.attach_logs(self._create_output_log(process, "stdout"), 
+                                self._create_output_log(process, "stderr"))
+        self._supervisor.reset(process)
+        self._capture(process, process.start(True))
+        self._mark_restart(process)
+        
+    def _respawn(self, process, replica):
+        """Restarts a replica that exited on its own (called by the supervisor)"""
+        if self._processes.get(process.name) is not process:
+            return
+        self._capture(process, process.respawn(replica, True))
+        self._mark_restart(process)
+            
+    def _mark_restart(self, process):
+        if self.log_dir is not None:
+            if self._processes.logs_cpu(process):
+                self._get_metric_writer(process, "cpu").restart(process.pid)
+            if self._processes.logs_memory(process):
+                self._get_metric_writer(process, "mem").restart(process.pid)
+                
+    def _capture(self, process, replicas):
+        """Reads the output of freshly spawned replicas, pins them to their CPUs
+        and has the supervisor watch them"""
+        for replica in replicas:
+            if process.affinity is not None:
+                if self._placer is None:
+                    self._placer = Placer()
+                self._placer.place(process, replica, self._processes)
+            self._reader.register(replica.stdout_pipe, process.output_reader(replica, "stdout"))
+            self._reader.register(replica.stderr_pipe, process.output_reader(replica, "stderr"))
+            self._supervisor.watch(process, replica)
+            
+    def scale_process(self, process, instances):
+        """Changes the number of replicas of a process, starting new ones if it is running"""
+        self._capture(process, process.scale(instances, True))
+                
+    def restart_process(self, process):
+        if process.active or process.restarting:
+            process.stop()
+        self.start_process(process)
+        
+    def rolling_restart(self, process, batch=1, check=None, timeout=None, abort=True):
+        """Restarts the replicas of a process a batch at a time, so the others
+        keep serving in the meantime.
+
+        Every batch is stopped gracefully and started again, then has to pass
+        the readiness check before the next one is restarted. A process with
+        a single replica is simply restarted, readiness check included.
+
+        Args:
+            process (Process): The process
+            batch (int, optional): Replicas restarted at once. Defaults to 1.
+            check (callable, optional): Readiness check (see `readiness`).
+                Defaults to the process's own, if it has one.
+            timeout (float, optional): Time every batch has to become ready.
+                Defaults to the process's readiness timeout.
+            abort (bool, optional): Stop at the first batch that fails, leaving
+                the remaining replicas untouched. Defaults to True.
+
+        Returns:
+            list: A `lifecycle.Result` per replica that was restarted
+        """
+        
+        if check is None:
+            check = process.ready
+        if timeout is None:
+            timeout = process.ready_timeout
+        replicas = process.replicas
+        results = []
+        for i in range(0, len(replicas), batch):
+            group = replicas[i:i + batch]
+            try:
+                self._capture(process, process.restart_replicas(group, True))
+                self._mark_restart(process)
+                if check is not None:
+                    wait_ready(process, check, timeout, replicas=group)
+            except OSError as e:
+                results.extend(Result(f"{process.name}[{r.index}]", False, str(e)) for r in group)
+                if abort:
+                    break
+            else:
+                results.extend(Result(f"{process.name}[{r.index}]", True) for r in group)
+        return results
+        
+    def launch_process(self, process, restart=False):
+        """(Re)starts a process and waits until it passes its readiness check"""
+        if self._stop:
+            raise OSError("pypm is shutting down")
+        for name in process.depends:
+            if self._processes.get(name) is None:
+                raise ValueError(f"Unknown dependency '{name}'")
+        if restart:
+            self.restart_process(process)
+        else:
+            self.start_process(process)
+        if process.ready is not None:
+            wait_ready(process, process.ready, process.ready_timeout)
+            
+    def start_processes(self, processes=None):
+        """Starts processes, and the stopped processes they depend on, in dependency order.
+
+        Every process is started as soon as all its dependencies are ready,
+        and processes that don't depend on each other start in parallel.
+        Dependencies that are already running are considered ready.
+
+        Returns:
+            list: A `lifecycle.Result` per process started
+        """
+        
+        if processes is None:
+            processes = self._processes
+        selected = {}
+        queue = list(processes)
+        while queue:
+            process = queue.pop(0)
+            if process.name in selected or process.active:
+                continue
+            selected[process.name] = process
+            queue.extend(filter(None, map(self._processes.get, process.depends)))
+        return self._lifecycle.run_ordered(self.launch_process, selected.values())
+    
+    def restart_processes(self, processes=None):
+        """Restarts processes in dependency order, as in `start_processes`"""
+        if processes is None:
+            processes = self._processes
+        return self._lifecycle.run_ordered(lambda p: self.launch_process(p, True), processes)
+        
+    def kill_process(self, process):
+        """Stops a process gracefully (see `Process.stop`)"""
+        if process.active or process.restarting:
+            process.stop()
+            
+    def stop_processes(self, processes=None, timeout=None):
+        """Stops processes gracefully, all at once.
+
+        Every process gets its stop signal right away, then each of them is
+        waited for until its own stop timeout or the global `timeout`,
+        whichever comes first, and killed along with its children if it is
+        still running.
+
+        Returns:
+            list: A `lifecycle.Result` per process that was running
+        """
+        
+        if processes is None:
+            processes = self._processes
+        processes = [p for p in processes if p.active or p.restarting]
+        start = time.monotonic()
+        children = {process.name: process.terminate() for process in processes}
+            
+        def reap(process):
+            deadline = start + process.stop_timeout
+            if timeout is not None:
+                deadline = min(deadline, start + timeout)
+            process.reap(deadline, children[process.name])
+        return self.run_all(reap, processes)
+            
+    def run_all(self, operation, processes=None):
+        """Applies a lifecycle operation to many processes in parallel.
+
+        Args:
+            operation (callable): e.g. `start_process` or `restart_process`
+            processes (iterable, optional): The processes. Defaults to all of them.
+
+        Returns:
+            list: A `lifecycle.Result` per process
+        """
+        
+        if processes is None:
+            processes = self._processes
+        return self._lifecycle.run(operation, processes)
+        
+    def get_process(self, name):
+        """Returns the managed process with the given name, or None"""
+        return self._processes.get(name)
             
     def assert_logdir_exists(self):
         if self.log_dir is None:
@@ -64,17 +336,60 @@ class ProcessManager:
         if not os.path.isdir(self.log_dir):
             os.mkdir(self.log_dir)
             
+    def _create_output_log(self, process, stream):
+        path = os.path.join(self.log_dir, f"{process.name}.{stream}.log")
+        return RotatingLog(path, 
+                           max_bytes=self.log_max_bytes, 
+                           interval=self.log_rotate_interval, 
+                           backups=self.log_backups, 
+                           max_age=self.log_max_age, 
+                           compression=self.log_compression, 
+                           compressor=self._compressor)
+            
+    def flush_output_logs(self):
+        for process in self._processes:
+            if process.logs is not None:
+                for log in process.logs:
+                    log.flush()
+            
+    def metrics_path(self, name, metric):
+        """Path of the file where a metric ("cpu" or "mem") of a process is logged"""
+        return os.path.join(self.log_dir, f"{name}_{metric}.metrics")
+            
+    def _get_metric_writer(self, process, metric):
+        with self._metric_writers_lock:
+            writer = self._metric_writers.get((process.name, metric))
+            if writer is None:
+                self.assert_logdir_exists()
+                path = self.metrics_path(process.name, metric)
+                unit = "%" if metric == "cpu" else "B"
+                rollups = []
+                try:
+                    for width in ROLLUP_WIDTHS:
+                        rollups.append(RollupWriter(rollup_path(path, width), metric, unit, width))
+                    writer = MetricWriter(path, metric, unit, self.log_period, rollups=rollups)
+                except (OSError, ValueError):
+                    for rollup in rollups:
+                        rollup.close()
+                    raise
+                self._metric_writers[(process.name, metric)] = writer
+            return writer
+        
+    def _close_metric_writers(self, name=None):
+        with self._metric_writers_lock:
+            for key in list(self._metric_writers):
+                if name is None or key[0] == name:
+                    self._metric_writers.pop(key).close()
+            
     def log_process_cpu(self, process):
-        self.assert_logdir_exists()
-        log_file = os.path.join(self.log_dir, process.name)
-        with open(log_file+"_log_cpu", "ab") as file:
-            file.write(struct.pack("d", process.get_cpu_perc()))
+        writer = self._get_metric_writer(process, "cpu")
+        writer.set_period(self.log_period)
+        writer.sample(self._sampler.get(process).cpu)
             
     def log_process_memory(self, process):
-        self.assert_logdir_exists()
-        log_file = os.path.join(self.log_dir, process.name)
-        with open(log_file+"_log_mem", "ab") as file:
-            file.write(struct.pack("d", process.get_mem_usage().bytes))
+        writer = self._get_metric_writer(process, "mem")
+        writer.set_period(self.log_period)
+        writer.sample(self._sampler.get(process).vms)
             
     def _process_command(self, command, sock):
         try:
@@ -107,6 +422,18 @@ class ProcessManager:
                 self._process_get_stdout(command, sock)
             elif command[0] == const.CMD_LIST:
                 self._process_list_cmd(command, sock)
+            elif command[0] == const.CMD_SNAPSHOT:
+                self._process_snapshot_cmd(command, sock)
+            elif command[0] == const.CMD_FOLLOW:
+                self._process_follow_cmd(command, sock)
+            elif command[0] == const.CMD_HISTORY:
+                self._process_history_cmd(command, sock)
+            elif command[0] == const.CMD_RECENT:
+                self._process_recent_cmd(command, sock)
+            elif command[0] == const.CMD_SCALE:
+                self._process_scale_cmd(command, sock)
+            elif command[0] == const.CMD_RELOAD:
+                self._process_reload_cmd(command, sock)
             else:
                 sock.sendall(const.MSG_CODE+b"Error: Unrecognized command") 
         except ConnectionResetError:
@@ -116,14 +443,13 @@ class ProcessManager:
         try:
             if len(command) == 2:
                 name = command[1]
-                out = None
-                for process in self._processes:
-                    if process.name == name:
-                        out = process.stdout
-                if out is None:
+                process = self._processes.get(name)
+                if process is None:
                     sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                 else:
-                    sock.sendall(const.DATA_CODE+out)
+                    # * Copied so the output reader never waits for a slow client
+                    data = process.stdout_buffer.getvalue()
+                    send_parts(sock, (const.DATA_CODE, data))
             else:
                 sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
         except Exception:
@@ -133,19 +459,302 @@ class ProcessManager:
         try:
             if len(command) == 2:
                 name = command[1]
-                err = None
-                for process in self._processes:
-                    if process.name == name:
-                        err = process.stderr
-                if err is None:
+                process = self._processes.get(name)
+                if process is None:
                     sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                 else:
-                    sock.sendall(const.DATA_CODE+err)
+                    # * Copied so the output reader never waits for a slow client
+                    data = process.stderr_buffer.getvalue()
+                    send_parts(sock, (const.DATA_CODE, data))
             else:
                 sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
         except Exception:
             sock.sendall(const.MSG_CODE+b"Error: Couldn't get stderr")
     
+    def snapshot(self, names=None, lines=0):
+        """Collects the state and resource usage of the managed processes.
+
+        Args:
+            names (list, optional): Only include these processes. Defaults to all.
+            lines (int, optional): Number of stdout/stderr lines to include. Defaults to 0.
+
+        Returns:
+            list: One dictionary per process
+        """
+        
+        if names:
+            processes = filter(None, map(self._processes.get, names))
+        else:
+            processes = self._processes
+        snapshot = []
+        for process in processes:
+            sample = self._sampler.get(process)
+            entry = {
+                "name": process.name,
+                "command": process.command,
+                "pid": process.pid,
+                "pids": process.pids,
+                "instances": process.instances,
+                "cpus": format_cpulist(process.cpus) if process.cpus else None,
+                "state": process.state,
+                "restarts": process.restarts,
+                "exit_code": process.last_exit_code,
+                "listen": list(process.listen),
+                "uptime": process.uptime.seconds,
+                "cpu": sample.cpu,
+                "rss": sample.rss,
+                "vms": sample.vms
+            }
+            if lines > 0:
+                entry["stdout"] = tail_lines(process.stdout_buffer, lines)
+                entry["stderr"] = tail_lines(process.stderr_buffer, lines)
+            snapshot.append(entry)
+        return snapshot
+            
+    def history(self, metric, names=None, start=None, end=None, points=100,
+                stats=("mean",), method="buckets"):
+        """Returns a downsampled time range of the logged CPU or memory usage.
+
+        Args:
+            metric (str): "cpu" or "mem"
+            names (list, optional): Only include these processes. Defaults to
+                all the processes whose metric is logged.
+            start (float, optional): Start of the range (UNIX time). Defaults
+                to an hour before `end`.
+            end (float, optional): End of the range (UNIX time). Defaults to now.
+            points (int, optional): Maximum number of points. Defaults to 100.
+            stats (tuple, optional): Statistics of every bucket, see
+                `downsample.aggregate`. Defaults to ("mean",).
+            method (str, optional): "buckets" or "lttb". Defaults to "buckets".
+
+        Returns:
+            dict: Maps each process name to a dictionary with the "times" and
+                the values of each statistic
+        """
+
+        self.assert_logdir_exists()
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - 3600
+        if not names:
+            names = [p.name for p in self._processes 
+                     if (self._processes.logs_cpu(p) if metric == "cpu" else self._processes.logs_memory(p))]
+        with self._metric_writers_lock:
+            writers = [w for (name, m), w in self._metric_writers.items() if m == metric and name in names]
+        for writer in writers:
+            writer.flush()
+        history = {}
+        for name in names:
+            path = self.metrics_path(name, metric)
+            if os.path.exists(path):
+                times, columns = query(path, start, end, points, stats, method)
+            else:
+                times, columns = [], {stat: [] for stat in stats}
+            history[name] = dict(times=times, **columns)
+        return history
+    
+    def _process_history_cmd(self, command, sock):
+        try:
+            args = command[1:]
+            if len(args) < 1 or args[0] not in ("cpu", "mem"):
+                sock.sendall(const.MSG_CODE+b"Error: Metric must be 'cpu' or 'mem'")
+                return
+            metric, args = args[0], args[1:]
+            kwargs, names = {}, []
+            while len(args) > 0:
+                if args[0] in ("--start", "--end", "--points", "--stats") and len(args) >= 2:
+                    key, value = args[0][2:], args[1]
+                    try:
+                        if key == "points":
+                            kwargs[key] = int(value)
+                            if kwargs[key] < 1:
+                                raise ValueError()
+                        elif key == "stats":
+                            kwargs[key] = tuple(value.split(","))
+                        else:
+                            # * Negative times are relative to now
+                            kwargs[key] = float(value)
+                            if kwargs[key] < 0:
+                                kwargs[key] += time.time()
+                    except ValueError:
+                        sock.sendall(const.MSG_CODE+f"Error: Invalid value for --{key}".encode())
+                        return
+                    args = args[2:]
+                elif args[0] == "--lttb":
+                    kwargs["method"] = "lttb"
+                    args = args[1:]
+                else:
+                    names.append(args[0])
+                    args = args[1:]
+            for name in names:
+                if self._processes.get(name) is None:
+                    sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                    return
+            try:
+                history = self.history(metric, names, **kwargs)
+            except ValueError as e:
+                sock.sendall(const.MSG_CODE+f"Error: {e}".encode())
+                return
+            data = json.dumps(history, separators=(",", ":"))
+            sock.sendall(const.DATA_CODE+data.encode("utf-8"))
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't get metrics history")
+
+    def _process_scale_cmd(self, command, sock):
+        try:
+            if len(command) != 3:
+                sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
+                return
+            name = command[1]
+            process = self._processes.get(name)
+            if process is None:
+                sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                return
+            try:
+                instances = parse_instances(command[2])
+            except ValueError as e:
+                sock.sendall(const.MSG_CODE+b"Error: " + str(e).encode())
+                return
+            self.scale_process(process, instances)
+            sock.sendall(const.MSG_CODE+f"Scaled process '{name}' to {instances} instances".encode())
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't scale process")
+
+    def _process_reload_cmd(self, command, sock):
+        try:
+            args = command[1:]
+            name, kwargs = None, {}
+            while len(args) > 0:
+                if args[0] in ("--batch", "--ready", "--timeout") and len(args) >= 2:
+                    key, value = args[0][2:], args[1]
+                    try:
+                        if key == "batch":
+                            kwargs["batch"] = int(value)
+                            if kwargs["batch"] < 1:
+                                raise ValueError("Batch size must be positive")
+                        elif key == "ready":
+                            kwargs["check"] = parse_check(value)
+                        else:
+                            kwargs["timeout"] = float(value)
+                            if kwargs["timeout"] <= 0:
+                                raise ValueError("Readiness timeout must be positive")
+                    except ValueError as e:
+                        sock.sendall(const.MSG_CODE+f"Error: Invalid value for --{key} ({e})".encode())
+                        return
+                    args = args[2:]
+                elif args[0] == "--keep-going":
+                    kwargs["abort"] = False
+                    args = args[1:]
+                elif name is None:
+                    name = args[0]
+                    args = args[1:]
+                else:
+                    sock.sendall(const.MSG_CODE+b"Error: Invalid arguments")
+                    return
+            if name is None:
+                sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
+                return
+            process = self._processes.get(name)
+            if process is None:
+                sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                return
+            if not process.active:
+                sock.sendall(const.MSG_CODE+b"Error: Process '" + name.encode() + b"' is not active")
+                return
+            if process.listen and isinstance(kwargs.get("check"), PortOpen):
+                sock.sendall(const.MSG_CODE+b"Error: Port readiness checks can't be used with listen, since the manager accepts the connections itself")
+                return
+            results = self.rolling_restart(process, **kwargs)
+            c = sum(1 for r in results if r.ok)
+            if c == process.instances:
+                sock.sendall(const.MSG_CODE+b"Successfully reloaded process '" + name.encode() + b"'")
+                return
+            message = f"Error: Restarted {c} out of {process.instances} replicas of '{name}'"
+            for result in results:
+                if not result.ok:
+                    message += f"\n  '{result.name}': {result.error}"
+            if len(results) < process.instances:
+                message += f"\n  Aborted, {process.instances - len(results)} replicas weren't restarted"
+            sock.sendall(const.MSG_CODE+message.encode())
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't reload process")
+
+    def _process_recent_cmd(self, command, sock):
+        try:
+            args = command[1:]
+            since = None
+            if len(args) >= 1 and args[0] == "--since":
+                try:
+                    since = time.time() - float(args[1])
+                except (IndexError, ValueError):
+                    sock.sendall(const.MSG_CODE+b"Error: Invalid value for --since")
+                    return
+                args = args[2:]
+            for name in args:
+                if self._processes.get(name) is None:
+                    sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                    return
+            names = args if args else [p.name for p in self._processes]
+            recent = {name: self._recent.get(name, since) for name in names}
+            sock.sendall(const.DATA_CODE+json.dumps(recent, separators=(",", ":")).encode("utf-8"))
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't get recent metrics")
+
+    def _process_snapshot_cmd(self, command, sock):
+        try:
+            args = command[1:]
+            lines = 0
+            if len(args) >= 1 and args[0] == "--lines":
+                if len(args) < 2 or not args[1].isdigit():
+                    sock.sendall(const.MSG_CODE+b"Error: Invalid number of lines")
+                    return
+                lines = int(args[1])
+                args = args[2:]
+            for name in args:
+                if self._processes.get(name) is None:
+                    sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                    return
+            data = json.dumps(self.snapshot(args, lines), separators=(",", ":"))
+            sock.sendall(const.DATA_CODE+data.encode("utf-8"))
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't get process snapshot")
+    
+    def _process_follow_cmd(self, command, sock):
+        try:
+            if isinstance(sock, FrameReply):
+                sock.sendall(const.MSG_CODE+b"Error: Following requires a dedicated (non-framed) connection")
+                return
+            args = command[1:]
+            name, stream, lines = None, "stdout", 0
+            while len(args) > 0:
+                if args[0] == "--stderr":
+                    stream = "stderr"
+                    args = args[1:]
+                elif args[0] == "--lines" and len(args) >= 2 and args[1].isdigit():
+                    lines = int(args[1])
+                    args = args[2:]
+                elif name is None:
+                    name = args[0]
+                    args = args[1:]
+                else:
+                    break
+            if name is None or len(args) != 0:
+                sock.sendall(const.MSG_CODE+b"Error: Invalid arguments")
+                return
+            process = self._processes.get(name)
+            if process is None:
+                sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
+                return
+        except Exception:
+            sock.sendall(const.MSG_CODE+b"Error: Couldn't follow process")
+            return
+        # * The connection is handed over to the output reader, which keeps 
+        # * streaming until the client disconnects
+        follower = Follower(socket.socket(fileno=sock.detach()))
+        self._reader.add_follower(follower)
+        process.follow(follower, stream, lines)
+    
     def _process_list_cmd(self, command, sock):
         try:
             if len(command) == 1:
@@ -162,14 +771,11 @@ class ProcessManager:
             if 1 <= len(command) <= 2:
                 if len(command) == 2:
                     name = command[1]
-                    uptime = None
-                    for process in self._processes:
-                        if process.name == name:
-                            uptime = str(process.uptime)
-                            break 
-                    if uptime is None:
+                    process = self._processes.get(name)
+                    if process is None:
                         sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     else:
+                        uptime = str(process.uptime)
                         sock.sendall(const.DATA_CODE+name.encode()+b"\x00"+uptime.encode()+b"\x00")
                 else:
                     uptime = []
@@ -189,19 +795,16 @@ class ProcessManager:
             if 1 <= len(command) <= 2:
                 if len(command) == 2:
                     name = command[1]
-                    memory = None
-                    for process in self._processes:
-                        if process.name == name:
-                            memory = process.get_mem_usage().bytes   
-                            break 
-                    if memory is None:
+                    process = self._processes.get(name)
+                    if process is None:
                         sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     else:
+                        memory = self._sampler.get(process).vms
                         sock.sendall(const.DATA_CODE+name.encode()+b"\x00"+struct.pack("d", memory))
                 else:
                     memory = []
                     for process in self._processes:
-                        memory.append((process.name, process.get_mem_usage().bytes))
+                        memory.append((process.name, self._sampler.get(process).vms))
                     message = []
                     for mem in memory:
                         message.append(mem[0].encode()+b"\x00"+struct.pack("d", mem[1]))
@@ -216,14 +819,11 @@ class ProcessManager:
             if 1 <= len(command) <= 2:
                 if len(command) == 2:
                     name = command[1]
-                    pid = None
-                    for process in self._processes:
-                        if process.name == name:
-                            pid = process.pid  
-                            break 
-                    if pid is None:
+                    process = self._processes.get(name)
+                    if process is None:
                         sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     else:
+                        pid = process.pid
                         sock.sendall(const.DATA_CODE+name.encode()+b"\x00"+struct.pack("i", pid))
                 else:
                     pid = []
@@ -243,19 +843,16 @@ class ProcessManager:
             if 1 <= len(command) <= 2:
                 if len(command) == 2:
                     name = command[1]
-                    cpu = None
-                    for process in self._processes:
-                        if process.name == name:
-                            cpu = process.get_cpu_perc()   
-                            break 
-                    if cpu is None:
+                    process = self._processes.get(name)
+                    if process is None:
                         sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     else:
+                        cpu = self._sampler.get(process).cpu
                         sock.sendall(const.DATA_CODE+name.encode()+b"\x00"+struct.pack("d", cpu))
                 else:
                     cpu = []
                     for process in self._processes:
-                        cpu.append((process.name, process.get_cpu_perc()))
+                        cpu.append((process.name, self._sampler.get(process).cpu))
                     message = []
                     for c in cpu:
                         message.append(c[0].encode()+b"\x00"+struct.pack("d", c[1]))
@@ -265,10 +862,64 @@ class ProcessManager:
         except Exception:
             sock.sendall(const.MSG_CODE+b"Error: Couldn't get process CPU usage")
             
+    def _process_options(self, options):
+        """Converts `addproc` options into `Process` keyword arguments"""
+        kwargs = {}
+        for key, value in options.items():
+            if key == "buffer":
+                kwargs["buffer_size"] = int(value)
+                if kwargs["buffer_size"] <= 0:
+                    raise ValueError("Buffer size must be positive")
+            elif key == "depends":
+                kwargs["depends"] = [d for d in value.split(",") if d]
+                if not all(d.isidentifier() for d in kwargs["depends"]):
+                    raise ValueError("Invalid dependency name")
+            elif key == "ready":
+                kwargs["ready"] = parse_check(value)
+            elif key == "instances":
+                kwargs["instances"] = parse_instances(value)
+            elif key == "port":
+                if not value.isdigit() or not 0 < int(value) < 65536:
+                    raise ValueError("Invalid port")
+                kwargs["port"] = int(value)
+            elif key == "cpus":
+                kwargs["affinity"] = parse_affinity(value)
+            elif key.startswith("env."):
+                if not key[4:]:
+                    raise ValueError("Invalid environment variable name")
+                kwargs.setdefault("env", {})[key[4:]] = value
+            elif key == "restart":
+                if value not in POLICIES:
+                    raise ValueError(f"Restart policy must be one of {', '.join(POLICIES)}")
+                kwargs["restart_policy"] = value
+            elif key == "max_restarts":
+                if not value.isdigit():
+                    raise ValueError("Maximum number of restarts must be a non-negative integer")
+                kwargs["max_restarts"] = int(value)
+            elif key == "listen":
+                kwargs["listen"] = [a for a in value.split(",") if a]
+                for address in kwargs["listen"]:
+                    parse_address(address)
+            elif key == "stop_signal":
+                kwargs["stop_signal"] = parse_signal(value)
+            elif key == "stop_timeout":
+                kwargs["stop_timeout"] = float(value)
+                if kwargs["stop_timeout"] < 0:
+                    raise ValueError("Stop timeout can't be negative")
+            elif key == "ready_timeout":
+                kwargs["ready_timeout"] = float(value)
+                if kwargs["ready_timeout"] <= 0:
+                    raise ValueError("Readiness timeout must be positive")
+            else:
+                raise ValueError(f"Unknown option '{key}'")
+        if kwargs.get("listen") and isinstance(kwargs.get("ready"), PortOpen):
+            raise ValueError("Port readiness checks can't be used with listen, since the manager accepts the connections itself")
+        return kwargs
+            
     def _process_command_add_proc(self, command, sock):
         try:
-            if len(command) == 6:
-                name, cmd, log_cpu, log_freq, dir_ = command[1:]
+            if len(command) >= 6:
+                name, cmd, log_cpu, log_freq, dir_ = command[1:6]
                 if len(name) > 16:
                     sock.sendall(const.MSG_CODE+b"Error: Name can't be over 16 characters long")
                     return
@@ -278,8 +929,21 @@ class ProcessManager:
                 if not cmd.isprintable():
                     sock.sendall(const.MSG_CODE+b"Error: Invalid command")
                     return
-                process = Process(name, cmd, dir_)
-                if self.add_process(process, sbool(log_cpu), sbool(log_freq)):
+                try:
+                    kwargs = self._process_options(parse_options(command[6:]))
+                except ValueError as e:
+                    sock.sendall(const.MSG_CODE+b"Error: " + str(e).encode())
+                    return
+                if name in kwargs.get("depends", ()):
+                    sock.sendall(const.MSG_CODE+b"Error: A process can't depend on itself")
+                    return
+                process = Process(name, cmd, dir_, **kwargs)
+                try:
+                    added = self.add_process(process, sbool(log_cpu), sbool(log_freq))
+                except OSError as e:
+                    sock.sendall(const.MSG_CODE+b"Error: " + str(e).encode())
+                    return
+                if added:
                     sock.sendall(const.MSG_CODE+b"Successfully added process '" + name.encode() + b"'")
                 else:
                     sock.sendall(const.MSG_CODE+b"Error: There is already a process named '" + name.encode() + b"'")
@@ -288,6 +952,23 @@ class ProcessManager:
         except Exception:
             sock.sendall(const.MSG_CODE+b"Error: Couldn't add process")
             
+    def _send_results(self, sock, verb, results, total):
+        """Replies with a summary of `run_all` results, listing every failure.
+
+        Args:
+            total (int): Number of processes the operation was meant for
+        """
+        
+        c = sum(1 for r in results if r.ok)
+        if c == 0:
+            message = f"Warning: No processes were {verb.lower()}"
+        else:
+            message = f"{verb} {c} out of {total} processes"
+        for result in results:
+            if not result.ok:
+                message += f"\n  '{result.name}': {result.error}"
+        sock.sendall(const.MSG_CODE+message.encode())
+            
     def _process_command_restart_proc(self, command, sock):
         try:
             if not (1 <= len(command) <= 2):
@@ -295,37 +976,17 @@ class ProcessManager:
                 return
             if len(command) == 2:
                 name = command[1]
-                process = None
-                for proc in self._processes:
-                    if proc.name == name:
-                        process = proc
-                        break 
+                process = self._processes.get(name)
                 if process is None:
                     sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     return
-                if process.active:
-                    process.kill()
-                process.start(True)
+                self.restart_process(process)
                 sock.sendall(const.MSG_CODE+b"Successfully restarted process '" + name.encode() + b"'")
             else:
                 if len(self._processes) == 0:
                     sock.sendall(const.MSG_CODE+b"Warning: No processes to restart")
                     return
-                c = 0
-                for process in self._processes:
-                    try:
-                        if process.active:
-                            process.kill()
-                        process.start(True)
-                        c += 1
-                    except Exception:
-                        pass
-                if c == 0:
-                    sock.sendall(const.MSG_CODE+b"Warning: No processes were restarted")
-                else:
-                    total = str(c).encode()
-                    length = str(len(self._processes)).encode()
-                    sock.sendall(const.MSG_CODE+b"Restarted " + total + b" out of " + length + b" processes")
+                self._send_results(sock, "Restarted", self.restart_processes(), len(self._processes))
                 
         except Exception:
             sock.sendall(const.MSG_CODE+b"Error: Couldn't restart process")
@@ -337,37 +998,27 @@ class ProcessManager:
                 return
             if len(command) == 2:
                 name = command[1]
-                process = None
-                for proc in self._processes:
-                    if proc.name == name:
-                        process = proc
-                        break 
+                process = self._processes.get(name)
                 if process is None:
                     sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                     return
                 if process.active:
                     sock.sendall(const.MSG_CODE+b"Warning: Process was already running, so nothing was done")
                 else:
-                    process.start(True)
+                    for result in self.start_processes([process]):
+                        if result.name == name and not result.ok:
+                            sock.sendall(const.MSG_CODE+f"Error: Couldn't start process '{name}': {result.error}".encode())
+                            return
                     sock.sendall(const.MSG_CODE+b"Successfully started process '" + name.encode() + b"'")
             else:
                 if len(self._processes) == 0:
                     sock.sendall(const.MSG_CODE+b"Warning: No processes to start")
                     return
-                c = 0
-                for process in self._processes:
-                    if not process.active:
-                        try:
-                            process.start(True)
-                            c += 1
-                        except Exception:
-                            pass
-                if c == 0:
+                stopped = [p for p in self._processes if not p.active]
+                if len(stopped) == 0:
                     sock.sendall(const.MSG_CODE+b"Warning: No processes were started")
-                else:
-                    total = str(c).encode()
-                    length = str(len(self._processes)).encode()
-                    sock.sendall(const.MSG_CODE+b"Started " + total + b" out of " + length + b" processes")
+                    return
+                self._send_results(sock, "Started", self.start_processes(stopped), len(stopped))
                 
         except Exception:
             sock.sendall(const.MSG_CODE+b"Error: Couldn't start process")
@@ -378,16 +1029,11 @@ class ProcessManager:
                 sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
                 return
             name = command[1]
-            process = None
-            for proc in self._processes:
-                if proc.name == name:
-                    process = proc
-                    break 
+            process = self._processes.get(name)
             if process is None:
                 sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                 return
-            if process.active:
-                process.kill()
+            self.kill_process(process)
             self.rem_process(process)
             sock.sendall(const.MSG_CODE+b"Successfully removed process '" + name.encode() + b"'")
             
@@ -396,20 +1042,23 @@ class ProcessManager:
             
     def _process_command_kill_proc(self, command, sock):
         try:
-            if len(command) != 2:
+            if not (1 <= len(command) <= 2):
                 sock.sendall(const.MSG_CODE+b"Error: Invalid number of arguments")
                 return
+            if len(command) == 1:
+                active = [p for p in self._processes if p.active or p.restarting]
+                if len(active) == 0:
+                    sock.sendall(const.MSG_CODE+b"Warning: No processes are active")
+                    return
+                self._send_results(sock, "Killed", self.stop_processes(active), len(active))
+                return
             name = command[1]
-            process = None
-            for proc in self._processes:
-                if proc.name == name:
-                    process = proc
-                    break 
+            process = self._processes.get(name)
             if process is None:
                 sock.sendall(const.MSG_CODE+b"Error: Couldn't find process '" + name.encode() + b"'")
                 return
-            if process.active:
-                process.kill()
+            if process.active or process.restarting:
+                process.stop()
                 sock.sendall(const.MSG_CODE+b"Successfully killed process '" + name.encode() + b"'")
             else:
                 sock.sendall(const.MSG_CODE+b"Error: Process '" + name.encode() + b"' is not active")
@@ -433,24 +1082,178 @@ class ProcessManager:
     
     def start(self):
         self._socket.bind(("localhost", self.port))
-        for process in self._processes:
-            process.start(True)
+        self._reader.start()
+        self._supervisor.start()
+        # * In the background, like `startall`: waiting for every dependency
+        # * level to be ready can take a while, commands are served meanwhile
+        self._autostart_thread = threading.Thread(target=self._autostart, name="pypm-autostart")
+        self._autostart_thread.start()
         self.main_loop()
+
+    def _autostart(self):
+        for result in self.start_processes():
+            if not result.ok:
+                logging.error(f"Couldn't start process '{result.name}': {result.error}")
         
     def server_loop(self):
+        """Accepts connections and dispatches their commands to the handler pool.
+
+        The listening socket, clients that haven't sent their command yet and
+        persistent (framed) connections are all multiplexed through a single
+        selector, so a slow client (or a slow command) never keeps the others
+        from being served.
+        
+        A connection whose first byte is `FRAME_CODE` is persistent: it carries
+        length-prefixed frames tagged with request IDs, which are handled
+        concurrently and answered in whatever order they complete. Any other
+        connection is a legacy one-shot connection carrying a single command.
+        
+        A persistent connection gets at most half the handlers, and isn't
+        read from while too many of its requests wait for one (see
+        `FramedConnection`); handlers wake the loop up through a socket pair
+        once it can be read from again.
+        """
         self._socket.listen()
-        while not self._stop:
+        self._socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self._socket, selectors.EVENT_READ)
+        wake_r, self._server_wake = socket.socketpair()
+        wake_r.setblocking(False)
+        self._server_wake.setblocking(False)
+        selector.register(wake_r, selectors.EVENT_READ)
+        pool = ThreadPoolExecutor(max_workers=self.workers, 
+                                  thread_name_prefix="pypm-handler")
+        try:
+            while not self._stop:
+                for key, _ in selector.select(timeout=0.5):
+                    if key.fileobj is self._socket:
+                        self._accept_connection(selector)
+                    elif key.fileobj is wake_r:
+                        self._resume_connections(wake_r, selector)
+                    elif key.data is None:
+                        self._identify_connection(key.fileobj, selector, pool)
+                    else:
+                        self._read_frames(key.data, selector, pool)
+        finally:
+            for key in list(selector.get_map().values()):
+                if key.fileobj is not self._socket and key.data is None:
+                    key.fileobj.close()
+            for connection in list(self._connections):
+                connection.close()
+            self._connections.clear()
+            selector.close()
+            pool.shutdown(wait=True)
+            wake_r.close()
+            self._server_wake.close()
+            
+    def _accept_connection(self, selector):
+        try:
+            sock, _ = self._socket.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            return
+        sock.setblocking(True)
+        selector.register(sock, selectors.EVENT_READ)
+        
+    def _identify_connection(self, sock, selector, pool):
+        try:
+            first = sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            first = b""
+        if first == b"":
+            selector.unregister(sock)
+            sock.close()
+        elif first == const.FRAME_CODE:
+            sock.recv(1)
+            connection = FramedConnection(sock, max(1, self.workers // 2))
+            self._connections.add(connection)
+            selector.modify(sock, selectors.EVENT_READ, connection)
+        else:
+            selector.unregister(sock)
+            pool.submit(self._handle_connection, sock)
+            
+    def _read_frames(self, connection, selector, pool):
+        try:
+            data = connection.sock.recv(65536)
+            if data == b"":
+                raise ConnectionError("Connection closed by peer")
+            connection.feed(data)
+        except OSError:
+            selector.unregister(connection.sock)
+            connection.close()
+            self._connections.discard(connection)
+            return
+        self._dispatch_frames(connection, pool)
+        if connection.backlogged:
+            # * Stop reading until its handlers catch up. Checking again
+            # * afterwards makes sure a handler that finished in between
+            # * doesn't leave it paused for good
+            connection.paused = True
+            selector.unregister(connection.sock)
+            if not connection.backlogged:
+                connection.paused = False
+                selector.register(connection.sock, selectors.EVENT_READ, connection)
+                
+    def _dispatch_frames(self, connection, pool):
+        for request_id, payload in connection.take():
+            pool.submit(self._handle_frame, connection, request_id, payload, pool)
+            
+    def _resume_connections(self, wake_r, selector):
+        try:
+            while wake_r.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        with self._resumed_lock:
+            resumed, self._resumed = self._resumed, []
+        for connection in resumed:
+            if connection.closed:
+                self._connections.discard(connection)
+            elif connection.paused:
+                connection.paused = False
+                selector.register(connection.sock, selectors.EVENT_READ, connection)
+        
+    def _handle_connection(self, sock):
+        sock.settimeout(SEND_TIMEOUT)
+        try:
+            command = sock.recv(2048).decode("utf-8")
+            self._process_command(command, sock)
+        except (ConnectionResetError, UnicodeDecodeError):
+            pass
+        except Exception:
+            logging.exception("Unhandled error while processing a command")
+        finally:
+            sock.close()
+            
+    def _handle_frame(self, connection, request_id, payload, pool):
+        reply = FrameReply(connection, request_id)
+        try:
+            self._process_command(payload.decode("utf-8"), reply)
+            if not reply.sent:
+                reply.sendall(const.MSG_CODE+b"Error: Command produced no response")
+        except UnicodeDecodeError:
+            reply.sendall(const.MSG_CODE+b"Error: Unrecognized command")
+        except OSError:
+            pass
+        except Exception:
+            logging.exception("Unhandled error while processing a command")
+        finally:
+            connection.done()
+        self._dispatch_frames(connection, pool)
+        if connection.paused and not connection.backlogged:
+            with self._resumed_lock:
+                self._resumed.append(connection)
             try:
-                sock, _ = self._socket.accept()
-                command = sock.recv(2048).decode("utf-8")
-                self._process_command(command, sock)
-                sock.close()
-            except ConnectionResetError:
+                self._server_wake.send(b"\x00")
+            except OSError:
                 pass
         
     def main_loop(self):
         try:
             start = time.time()
+            self._sampler.start()
+            self._compressor.start()
+            if self._exporter is not None:
+                self._exporter.start()
             self._server_thread = threading.Thread(target=self.server_loop)
             self._server_thread.start()
             while not self._stop:
@@ -458,13 +1261,12 @@ class ProcessManager:
                     
                     start = time.time()
                     for process in self._processes:
-                        if process in self._log_memory:
+                        self._recent.record(process.name, start, self._sampler.get(process))
+                        if self._processes.logs_memory(process):
                             self.log_process_memory(process)
-                        if process in self._log_cpu:
+                        if self._processes.logs_cpu(process):
                             self.log_process_cpu(process)
-                        if process.active:
-                            process.process_stdout()
-                            process.process_stderr()
+                    self.flush_output_logs()
                 else:
                     time.sleep(max(self.log_period - (time.time() - start), 0))
         except KeyboardInterrupt:    
@@ -472,22 +1274,27 @@ class ProcessManager:
         finally:
             self._stop = True
             
-            # * In case the server_loop hasn't stopped yet, prevent
-            # * socket.accept() from hanging by connecting
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.setblocking(0)
-                s.settimeout(0.5)
-                s.connect(("localhost", self.port))
-                s.sendall(b" ")
-                ready = select.select([s], [], [], 0.6)  # See if data is available
-                if ready[0]:
-                    s.recv(1024)
-                s.close()
-            except:
-                pass
+            # * The server loop wakes up at least every 0.5s to check for
+            # * the stop flag, and waits for in-flight commands to finish
+            if self._server_thread is not None:
+                self._server_thread.join()
+            if self._exporter is not None:
+                self._exporter.stop()
+            self._sampler.stop()
             
             self._socket.close()
+            self._supervisor.stop()
+            self.stop_processes(timeout=self.shutdown_timeout)
+            if self._autostart_thread is not None:
+                # * Processes it was still starting are stopped once it gives up
+                self._autostart_thread.join()
+                self.stop_processes(timeout=self.shutdown_timeout)
+            self._listeners.close()
+            self._lifecycle.shutdown()
+            self._reader.stop()
             for process in self._processes:
-                if process.active:
-                    process.kill()
+                if process.logs is not None:
+                    for log in process.logs:
+                        log.close()
+            self._compressor.stop()
+            self._close_metric_writers()
@@ -0,0 +1,311 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+from . import downsample
+
+# * File layout: a fixed-size header followed by fixed-size records
+# *   header: magic, schema version, metric name, unit, sampling period (s)
+# *   record: kind, timestamp (UNIX time, s), value
+MAGIC = b"PYPMTS"
+VERSION = 1
+HEADER = struct.Struct("<6sH8s8sd")
+RECORD = struct.Struct("<B7xdd")
+
+# * Record kinds
+SAMPLE = 0
+RESTART = 1  # value is the PID of the new process
+PERIOD = 2   # value is the new sampling period
+
+# * Rollup files share the header layout (the period is the bucket width)
+# *   record: bucket start (UNIX time, s), sample count, min, max, mean
+ROLLUP_MAGIC = b"PYPMRU"
+ROLLUP = struct.Struct("<ddddd")
+ROLLUP_WIDTHS = (60, 3600)
+
+
+def rollup_path(path, width):
+    """Path of the rollup file with `width` seconds buckets of a metrics file"""
+    return f"{os.path.splitext(path)[0]}.{width}s.rollup"
+
+def pack_header(metric, unit, period, magic=MAGIC):
+    return HEADER.pack(magic, VERSION, metric.encode(), unit.encode(), period)
+
+def unpack_header(data, magic=MAGIC):
+    """Decodes a file header.
+
+    Returns:
+        dict: The schema version, metric name, unit and sampling period
+
+    Raises:
+        ValueError: If the data isn't a valid header
+    """
+
+    if len(data) < HEADER.size:
+        raise ValueError("Metrics file is too short")
+    found, version, metric, unit, period = HEADER.unpack_from(data)
+    if found != magic:
+        raise ValueError("Not a pypm metrics file")
+    if version > VERSION:
+        raise ValueError(f"Unsupported metrics file version ({version})")
+    return {
+        "version": version,
+        "metric": metric.rstrip(b"\x00").decode(),
+        "unit": unit.rstrip(b"\x00").decode(),
+        "period": period
+    }
+
+
+def read_range(path, start=None, end=None, magic=MAGIC):
+    """Reads the records of a metrics (or rollup) file within a time range.
+
+    The file is memory-mapped and the bounds of the range are found with a
+    binary search on the timestamps, so only the records in the range are
+    read. This assumes the timestamps are increasing.
+
+    Args:
+        path (str): The file
+        start (float, optional): First UNIX time included. Defaults to the start of the file.
+        end (float, optional): First UNIX time excluded. Defaults to the end of the file.
+        magic (bytes, optional): `MAGIC`, or `ROLLUP_MAGIC` for rollup files
+
+    Returns:
+        tuple: The header (as returned by `unpack_header`) and a list of
+            `RECORD` (or `ROLLUP`) tuples
+    """
+
+    record = RECORD if magic == MAGIC else ROLLUP
+    # * Offset of the timestamp in a record
+    offset = 8 if magic == MAGIC else 0
+    with open(path, "rb") as file:
+        header = unpack_header(file.read(HEADER.size), magic)
+        count = (os.fstat(file.fileno()).st_size - HEADER.size) // record.size
+        if count == 0:
+            return header, []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            def search(timestamp):
+                low, high = 0, count
+                while low < high:
+                    mid = (low + high) // 2
+                    t, = struct.unpack_from("<d", data, HEADER.size + mid * record.size + offset)
+                    if t < timestamp:
+                        low = mid + 1
+                    else:
+                        high = mid
+                return low
+            first = 0 if start is None else search(start)
+            last = count if end is None else search(end)
+            if first >= last:
+                return header, []
+            return header, list(record.iter_unpack(
+                data[HEADER.size + first * record.size:HEADER.size + last * record.size]
+            ))
+
+def query(path, start, end, points=1000, stats=("mean",), method="buckets"):
+    """Returns a downsampled time range of a metrics file.
+
+    The range is read from the metrics file or from one of its rollup files,
+    whichever is the finest one that doesn't need more than a few rows per
+    point (see `downsample.choose_width`).
+
+    Args:
+        path (str): The metrics file
+        start (float): Start of the range (UNIX time)
+        end (float): End of the range (UNIX time), exclusive
+        points (int, optional): Maximum number of points. Defaults to 1000.
+        stats (tuple, optional): Statistics of every bucket, see
+            `downsample.aggregate`. Defaults to ("mean",).
+        method (str, optional): "buckets", or "lttb" to pick representative
+            samples instead (`stats` is then ignored). Defaults to "buckets".
+
+    Returns:
+        tuple: The times, and a dict mapping each statistic (or "value", for
+            LTTB) to its values
+    """
+
+    with open(path, "rb") as file:
+        header = unpack_header(file.read(HEADER.size))
+    widths = {header["period"]: path}
+    for width in ROLLUP_WIDTHS:
+        if os.path.exists(rollup_path(path, width)):
+            widths[width] = rollup_path(path, width)
+    width = downsample.choose_width(list(widths), start, end, points)
+    rows, tail = [], start
+    if widths[width] != path:
+        _, rows = read_range(widths[width], start, end, ROLLUP_MAGIC)
+        # * The bucket in progress isn't in the rollup file yet, the samples
+        # * after the last complete bucket are read from the metrics file
+        if rows:
+            tail = rows[-1][0] + width
+    _, records = read_range(path, tail, end)
+    rows += [(t, 1, v, v, v) for kind, t, v in records if kind == SAMPLE]
+    if method == "lttb":
+        times, values = downsample.lttb([r[0] for r in rows], [r[4] for r in rows], points)
+        return times, {"value": values}
+    return downsample.aggregate(rows, start, end, points, stats)
+
+
+class RollupWriter:
+    def __init__(self, path, metric, unit, width, buffer_size=2**12):
+        """Maintains a file of min/max/mean aggregates of a metric over fixed time buckets.
+
+        A bucket is written once a sample falls into the next one. The bucket
+        in progress is written when the writer is closed, and picked up again
+        (and overwritten) if the file is reopened while it is still current.
+
+        Args:
+            path (str): The file, created with a header if it doesn't exist
+            metric (str): Name of the metric (at most 8 bytes)
+            unit (str): Unit of the values (at most 8 bytes)
+            width (int): Width of the buckets, in seconds
+            buffer_size (int, optional): Size of the write buffer. Defaults to 4KB.
+        """
+
+        self.path = path
+        self.width = width
+        self._lock = threading.Lock()
+        self._bucket = None
+        self._count = 0
+        self._min = self._max = self._sum = 0.0
+        self._file = open(path, "ab", buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(pack_header(metric, unit, width, ROLLUP_MAGIC))
+            return
+        try:
+            with open(path, "rb") as file:
+                unpack_header(file.read(HEADER.size), ROLLUP_MAGIC)
+                end = self._file.tell()
+                end -= (end - HEADER.size) % ROLLUP.size
+                if end > HEADER.size:
+                    file.seek(end - ROLLUP.size)
+                    last = ROLLUP.unpack(file.read(ROLLUP.size))
+                    if last[0] + width > time.time():
+                        # * Resume the bucket that was in progress
+                        end -= ROLLUP.size
+                        self._bucket, self._count, self._min, self._max, mean = last
+                        self._sum = mean * self._count
+        except ValueError:
+            self._file.close()
+            raise
+        if end != self._file.tell():
+            self._file.truncate(end)
+            self._file.seek(0, os.SEEK_END)
+
+    def add(self, timestamp, value):
+        bucket = timestamp - timestamp % self.width
+        with self._lock:
+            if self._file.closed:
+                return
+            if bucket != self._bucket:
+                self._write_bucket()
+                self._bucket = bucket
+                self._count = 0
+                self._min = self._max = value
+                self._sum = 0.0
+            self._count += 1
+            self._min = min(self._min, value)
+            self._max = max(self._max, value)
+            self._sum += value
+
+    def _write_bucket(self):
+        if self._count > 0:
+            self._file.write(ROLLUP.pack(self._bucket, self._count, self._min,
+                                         self._max, self._sum / self._count))
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._write_bucket()
+                self._file.close()
+
+
+class MetricWriter:
+    def __init__(self, path, metric, unit, period, flush_interval=10, buffer_size=2**14,
+                 rollups=()):
+        """Appends timestamped samples of a metric to a file that is kept open.
+
+        Records are buffered and only written out every `flush_interval`
+        seconds (or when the buffer fills up), instead of costing an
+        open/write/close on every sample.
+
+        Args:
+            path (str): The file, created with a header if it doesn't exist
+            metric (str): Name of the metric (at most 8 bytes)
+            unit (str): Unit of the values (at most 8 bytes)
+            period (float): Sampling period, in seconds
+            flush_interval (float, optional): Seconds between flushes. Defaults to 10.
+            buffer_size (int, optional): Size of the write buffer. Defaults to 16KB.
+            rollups (iterable, optional): `RollupWriter`s fed with every sample.
+        """
+
+        self.path = path
+        self.rollups = list(rollups)
+        self.period = period
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._file = open(path, "ab", buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(pack_header(metric, unit, period))
+        else:
+            try:
+                with open(path, "rb") as file:
+                    unpack_header(file.read(HEADER.size))
+            except ValueError:
+                self._file.close()
+                raise
+            # * Drop a partial record left behind by a crash
+            extra = (self._file.tell() - HEADER.size) % RECORD.size
+            if extra != 0:
+                self._file.truncate(self._file.tell() - extra)
+                self._file.seek(0, os.SEEK_END)
+            self._write(PERIOD, period)
+
+    def _write(self, kind, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD.pack(kind, timestamp, value))
+            if timestamp - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                for rollup in self.rollups:
+                    rollup.flush()
+                self._last_flush = time.time()
+
+    def sample(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._write(SAMPLE, value, timestamp)
+        for rollup in self.rollups:
+            rollup.add(timestamp, value)
+
+    def restart(self, pid, timestamp=None):
+        """Marks that the process was (re)started"""
+        self._write(RESTART, pid, timestamp)
+
+    def set_period(self, period, timestamp=None):
+        if period != self.period:
+            self.period = period
+            self._write(PERIOD, period, timestamp)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            for rollup in self.rollups:
+                rollup.flush()
+            self._last_flush = time.time()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            for rollup in self.rollups:
+                rollup.close()
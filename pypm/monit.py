@@ -1,17 +1,16 @@
 import curses
-import sys
+import datetime
+import json
 import threading
 import time
 import traceback
 
-from .__main__ import (process_cpu_command, process_mem_command,
-                       process_pid_command, process_stderr_command,
-                       process_stdout_command, process_uptime_command,
-                       process_kill_command, process_start_command,
-                       send_command)
+from . import constants as const
+from .__main__ import send_command, send_commands
 from .units import Size, Time
 
 RATE = 0.1
+LOG_LINES = 500
 CTRL_Z = 26
 CTRL_C = 3
 K_UP = 450
@@ -74,31 +73,31 @@ class App:
             while not self._stop:
                 if len(self._processes) > 0:
                     keys = list(self._processes.keys())
-                    # proc = keys[self._selected_proc]
+                    selected = keys[self._selected_proc]
                     if time.time()-start > RATE:
-                        for i in range(len(self._processes)):
-                            proc = keys[i]
-                            # if time.time()-start > RATE:
-                            mem = process_mem_command([proc], self._host, self._port)
-                            if mem is None:
-                                break
-                            cpu = process_cpu_command([proc], self._host, self._port)
-                            if cpu is None:
-                                break
-                            uptime = process_uptime_command([proc], self._host, self._port)
-                            if uptime is None:
-                                break
-                            pid = process_pid_command([proc], self._host, self._port)
-                            if pid is None:
-                                break
-                            stdout = process_stdout_command([proc], self._host, self._port)
-                            stderr = process_stderr_command([proc], self._host, self._port)
-                            self._processes[proc]["pid"] = pid[proc] if pid[proc] != -1 else "N/A"
-                            self._processes[proc]["uptime"] = uptime[proc]
-                            self._processes[proc]["mem"] = mem[proc]
-                            self._processes[proc]["cpu"] = str(cpu[proc])+"%"
-                            self._processes[proc]["logs"]["stdout"] = stdout
-                            self._processes[proc]["logs"]["stderr"] = stderr
+                        # * A single round trip gets the status of every process
+                        # * and the logs of the one being displayed
+                        resp, logs = send_commands([
+                            (const.CMD_SNAPSHOT, []),
+                            (const.CMD_SNAPSHOT, ["--lines", str(LOG_LINES), selected])
+                        ], self._host, self._port)
+                        if resp[0] != const.DATA_CODE[0]:
+                            break
+                        for info in json.loads(resp[1:].decode("utf-8")):
+                            proc = info["name"]
+                            if proc not in self._processes:
+                                self.add_process(proc, info["command"])
+                            uptime = datetime.timedelta(seconds=info["uptime"])
+                            self._processes[proc]["pid"] = info["pid"] if info["pid"] != -1 else "N/A"
+                            if info["instances"] > 1:
+                                self._processes[proc]["pid"] = f"{self._processes[proc]['pid']} ({len(info['pids'])}/{info['instances']})"
+                            self._processes[proc]["uptime"] = str(Time(uptime))
+                            self._processes[proc]["mem"] = Size(info["vms"])
+                            self._processes[proc]["cpu"] = str(info["cpu"])+"%"
+                        if logs[0] == const.DATA_CODE[0]:
+                            for info in json.loads(logs[1:].decode("utf-8")):
+                                self._processes[info["name"]]["logs"]["stdout"] = info["stdout"]
+                                self._processes[info["name"]]["logs"]["stderr"] = info["stderr"]
                         start = time.time()
                     self.schedule_update(["botright", "topright", "topleft"])
         except Exception:
@@ -1,136 +1,581 @@
 import datetime
 import os
+import select
+import signal
 import subprocess
-import tempfile
+import sys
 import threading
+import time
 
-import psutil
+from .buffer import RingBuffer
+from .units import Time
 
-from .units import Size, Time
+# * Exec shim handing the listening sockets to the command (see `activate`)
+ACTIVATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "activate.py")
+
+
+def has_exited(popen):
+    """Tells whether a child exited, without reaping it (its PID stays reserved until then)"""
+    if popen.returncode is not None:
+        return True
+    if not hasattr(os, "waitid"):
+        return popen.poll() is not None
+    try:
+        return os.waitid(os.P_PID, popen.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        return True
+
+def wait_exit(popen, deadline):
+    """Waits for a child to exit until `deadline` (a `time.monotonic()` time),
+    without reaping it"""
+    if hasattr(os, "pidfd_open") and popen.returncode is None:
+        try:
+            fd = os.pidfd_open(popen.pid)
+        except ProcessLookupError:
+            return
+        except OSError:
+            pass
+        else:
+            try:
+                select.select([fd], [], [], max(0, deadline - time.monotonic()))
+            finally:
+                os.close(fd)
+            return
+    while not has_exited(popen) and time.monotonic() < deadline:
+        time.sleep(min(0.05, max(0, deadline - time.monotonic())))
+
+
+class Replica:
+    def __init__(self, index):
+        """One running copy of a process's command (a process has `instances` of them)"""
+        self.index = index
+        self.popen = None
+        # * Held while signalling or reaping a child, so that its process
+        # * group is only ever signalled while its PID can't be reused
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.cpus = None
+        # * False once the replica was stopped on purpose, so the
+        # * supervisor doesn't bring it back
+        self.wanted = False
+        # * Set once the supervisor tracks the replica's exit, after which
+        # * `running` is kept up to date without polling
+        self.watched = False
+        self.running = False
+        self.exit_code = None
+        # * Where its output starts in the process's buffers, for readiness checks
+        self.output_start = {"stdout": 0, "stderr": 0}
+
+    @property
+    def active(self):
+        if self.watched:
+            return self.running
+        return self.popen is not None and not has_exited(self.popen)
+    
+    def exited(self, popen):
+        """Records that the given child of this replica was reaped"""
+        if popen is self.popen:
+            self.running = False
+            self.exit_code = popen.returncode
+
+    @property
+    def pid(self):
+        return self.popen.pid if self.active else -1
+
+    @property
+    def stdout_pipe(self):
+        return self.popen.stdout
+
+    @property
+    def stderr_pipe(self):
+        return self.popen.stderr
+
+    def send_signal(self, sig):
+        """Sends a signal to the replica's whole process group, so it won't be restarted"""
+        with self.lock:
+            self.wanted = False
+            if self.popen is not None:
+                self._signal_group(self.popen, sig)
+
+    @staticmethod
+    def _signal_group(popen, sig):
+        # * Called with the lock held: as long as the child isn't reaped,
+        # * the group ID is still its own
+        if popen.returncode is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(popen.pid, sig)
+            else:
+                popen.send_signal(sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def reap(self, deadline, popen=None):
+        """Waits for the replica's child (by default the current one) to exit
+        until `deadline` (a `time.monotonic()` time), then kills whatever is
+        left of its process group"""
+        popen = self.popen if popen is None else popen
+        if popen is None:
+            return
+        wait_exit(popen, deadline)
+        self.collect(popen)
+
+    def collect(self, popen):
+        """Reaps a child of the replica, once it exited or is about to.
+
+        Whatever is left of its process group (the child if it's still running,
+        the children it left behind) is killed first, but only if the child
+        wasn't reaped already: its PID could have been reused by then.
+        """
+        with self.lock:
+            if popen.returncode is None:
+                self._signal_group(popen, signal.SIGKILL)
+                popen.wait()
+            self.exited(popen)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+        self.reap(0)
 
 
 class Process:
-    def __init__(self, name, command, dir="."):
-        self.max_buff_size = 10000
+    def __init__(self, name, command, dir=".", buffer_size=10000, depends=(), 
+                 ready=None, ready_timeout=30, env=None, instances=1, port=None, affinity=None,
+                 restart_policy="on-failure", max_restarts=10, stop_signal=signal.SIGTERM,
+                 stop_timeout=10, listen=()):
+        """A managed command, run as one or more identical `Replica`s.
+
+        Every replica gets PYPM_INSTANCE (its index) and PYPM_INSTANCES in its
+        environment, and PORT (`port` + index) if a base port is given. The
+        output of all the replicas goes to the same buffers and logs, a line
+        at a time (see `output_reader`).
+        
+        `affinity` is a CPU placement policy (see `affinity.parse_affinity`),
+        applied by the manager once a replica is spawned.
+        
+        `restart_policy` ("always", "on-failure" or "never") tells the
+        manager's supervisor whether to restart replicas that exit on their
+        own; `max_restarts` caps how often it does so within its window
+        before the process is considered crashed.
+        
+        Every replica runs in its own session, so that stopping it reaches
+        the children it spawned too: its process group gets `stop_signal`,
+        then SIGKILL if it is still running after `stop_timeout` seconds.
+        
+        `listen` declares addresses (see `listeners.parse_address`) the
+        manager listens on for the process. Their sockets are set in
+        `listen_sockets` and passed to every replica as file descriptors 3,
+        4, ... with LISTEN_FDS, LISTEN_PID and LISTEN_FDNAMES, as with
+        systemd's socket activation.
+        """
+        
+        self.max_buff_size = buffer_size
         self.name = name
+        self.env = dict(env) if env is not None else {}
+        self.depends = tuple(depends)
+        self.ready = ready
+        self.ready_timeout = ready_timeout
+        self.port = port
+        self.affinity = affinity
+        self.restart_policy = restart_policy
+        self.max_restarts = max_restarts
+        self.stop_signal = stop_signal
+        self.stop_timeout = stop_timeout
+        self.listen = tuple(listen)
+        self.listen_sockets = []
+        self.last_exit_code = None
+        self.crashed = False
         self._command = command
-        self._process = None
-        self._start = Time(0)
-        self._cpu_usage = 0
-        self._thread = None
-        self._outstream = None
-        self._errstream = None
-        self._outbuff = b""
-        self._errbuff = b""
+        self._replicas = [Replica(i) for i in range(instances)]
+        self._started = False
+        self.restarts = 0
+        self._outbuff = RingBuffer(buffer_size)
+        self._errbuff = RingBuffer(buffer_size)
+        self._outlog = None
+        self._errlog = None
+        self._outfollowers = []
+        self._errfollowers = []
         self._dir = dir
+        self._lock = threading.RLock()
         print(self._dir)
         
     def __eq__(self, other):
         return isinstance(other, Process) and other.name == self.name
         
     def start(self, pipe=False):
-        previous = os.path.abspath(os.curdir)
-        os.chdir(self._dir)
-        if self.active:
-            raise OSError("Process is already running")
-        self._start = datetime.datetime.now()
-        if pipe:
-            self._outstream = tempfile.TemporaryFile()
-            self._errstream = tempfile.TemporaryFile()
-            self._process = subprocess.Popen(self._command.split(),
-                                             stdout=self._outstream,
-                                             stderr=self._errstream)
+        """Starts every replica.
+
+        Returns:
+            list: The `Replica`s that were started
+        """
+        
+        with self._lock:
+            if self.active:
+                raise OSError("Process is already running")
+            if self._started:
+                self.restarts += 1
+            self._started = True
+            self.crashed = False
+            started = []
+            try:
+                for replica in self._replicas:
+                    self._spawn(replica, pipe)
+                    started.append(replica)
+            except OSError:
+                for replica in started:
+                    replica.kill()
+                raise
+            return started
+        
+    def _spawn(self, replica, pipe):
+        replica.start_time = datetime.datetime.now()
+        replica.cpus = None
+        # * The working directory and environment are only set in the
+        # * child, so processes can be spawned from several threads at
+        # * once. Without a preexec_fn, CPython spawns with vfork (or
+        # * posix_spawn), which doesn't copy the manager's page tables
+        pipe = subprocess.PIPE if pipe else None
+        args = self._command.split()
+        fds = [sock.fileno() for sock in self.listen_sockets]
+        if fds:
+            args = [sys.executable, "-S", ACTIVATE, ",".join(map(str, fds))] + args
+        try:
+            popen = subprocess.Popen(args,
+                                     cwd=self._dir,
+                                     env=self.environment(replica),
+                                     stdout=pipe,
+                                     stderr=pipe,
+                                     start_new_session=True,
+                                     pass_fds=fds)
+        except OSError:
+            # * Nothing to wait for, so it isn't left "restarting"
+            with replica.lock:
+                replica.wanted = False
+            raise
+        # * Only marked as wanted once it runs, the supervisor checks these
+        # * under the replica's lock
+        with replica.lock:
+            replica.popen = popen
+            replica.output_start = {"stdout": self._outbuff.end, "stderr": self._errbuff.end}
+            replica.wanted = True
+            replica.watched = False
+            replica.running = True
+            replica.exit_code = None
+            
+    def respawn(self, replica, pipe=False):
+        """Starts a single replica again after it exited on its own.
+
+        Returns:
+            list: The `Replica`s that were started (none if it is running again or was stopped)
+        """
+        
+        with self._lock:
+            if replica.active or not replica.wanted or replica not in self._replicas:
+                return []
+            self.restarts += 1
+            self._spawn(replica, pipe)
+            return [replica]
+            
+    def restart_replicas(self, replicas, pipe=False):
+        """Stops some of the replicas gracefully and starts them again, leaving
+        the others running.
+
+        Returns:
+            list: The `Replica`s that were started
+        """
+        
+        deadline = time.monotonic() + self.stop_timeout
+        with self._lock:
+            replicas = [r for r in replicas if r in self._replicas]
+            children = self._signal(replicas)
+        self._reap(children, deadline)
+        with self._lock:
+            # * Unless they were removed or started again meanwhile
+            replicas = [r for r in replicas if r in self._replicas and not r.active]
+            self.restarts += 1
+            self.crashed = False
+            for replica in replicas:
+                self._spawn(replica, pipe)
+            return replicas
+            
+    def environment(self, replica):
+        """The environment of one of the replicas"""
+        env = dict(os.environ)
+        env.update(self.env)
+        env["PYPM_INSTANCE"] = str(replica.index)
+        env["PYPM_INSTANCES"] = str(len(self._replicas))
+        if self.port is not None:
+            env["PORT"] = str(self.port + replica.index)
+        if self.listen_sockets:
+            env["LISTEN_FDNAMES"] = ":".join([self.name] * len(self.listen_sockets))
         else:
-            self._process = subprocess.Popen(self._command.split())
-        os.chdir(previous)
+            # * Set if the manager itself was socket-activated, and not meant
+            # * for its children
+            for key in ("LISTEN_FDS", "LISTEN_PID", "LISTEN_FDNAMES"):
+                env.pop(key, None)
+        return env
+    
+    def scale(self, instances, pipe=False):
+        """Changes the number of replicas.
+
+        New replicas are only started if the process is running, and extra
+        ones are stopped (the highest indices first).
+
+        Returns:
+            list: The `Replica`s that were started
+        """
+        
+        deadline = time.monotonic() + self.stop_timeout
+        with self._lock:
+            started = []
+            running = self.active
+            removed = self._replicas[instances:]
+            del self._replicas[instances:]
+            children = self._signal(removed)
+            while len(self._replicas) < instances:
+                replica = Replica(len(self._replicas))
+                self._replicas.append(replica)
+                if running:
+                    self._spawn(replica, pipe)
+                    started.append(replica)
+        self._reap(children, deadline)
+        return started
+        
+    @property
+    def instances(self):
+        return len(self._replicas)
+    
+    @property
+    def replicas(self):
+        return list(self._replicas)
             
     @property
     def stdout(self):
-        return self._outbuff
+        return self._outbuff.getvalue()
     
     @property
     def stderr(self):
+        return self._errbuff.getvalue()
+    
+    @property
+    def stdout_buffer(self):
+        return self._outbuff
+    
+    @property
+    def stderr_buffer(self):
         return self._errbuff
+    
+    @property
+    def logs(self):
+        """The (stdout, stderr) log files, or None if output isn't persisted"""
+        if self._outlog is None:
+            return None
+        return self._outlog, self._errlog
+    
+    def attach_logs(self, stdout, stderr):
+        """Persists all further output to the given `RotatingLog`s"""
+        self._outlog = stdout
+        self._errlog = stderr
             
-    def process_stdout(self):
-        new = self.get_stdout().replace(b"\x00", b"")
-        self._outbuff += new
-        start = max(0, len(self._outbuff)-self.max_buff_size)
-        self._outbuff = self._outbuff[start:]
+    def output_reader(self, replica, stream):
+        """Returns the callback reading one of a replica's pipes.
+
+        The output of a process with a single replica is added as it arrives.
+        With several replicas, only complete lines are added, prefixed with
+        the replica's index ("[1] "), so the lines of different replicas are
+        never mixed up. A line longer than the buffer, or left unfinished
+        when the pipe is closed, is then ended with a newline.
+
+        Args:
+            replica (Replica): The replica
+            stream (str): "stdout" or "stderr"
+        """
+
+        feed = self.feed_stdout if stream == "stdout" else self.feed_stderr
+        carry = b""
+
+        def read(data):
+            nonlocal carry
+            if not carry and len(self._replicas) <= 1:
+                if data:
+                    feed(data)
+                return
+            closed = data == b""
+            if carry:
+                data = carry + data
+            end = data.rfind(b"\n") + 1
+            if end < len(data) and (closed or len(data) - end >= self.max_buff_size):
+                # * The pipe was closed mid-line, or the line won't fit in the buffer anyway
+                data += b"\n"
+                end = len(data)
+            carry = data[end:]
+            if end > 0:
+                feed(self._tag(replica, data[:end]))
+
+        return read
+
+    def _tag(self, replica, lines):
+        if len(self._replicas) <= 1:
+            return lines
+        prefix = b"[%d] " % replica.index
+        return prefix + lines[:-1].replace(b"\n", b"\n" + prefix) + b"\n"
+
+    def feed_stdout(self, data):
+        """Appends output read from the stdout pipe, keeping the last `max_buff_size` bytes"""
+        with self._outbuff.lock:
+            self._outbuff.append(data)
+            self._push(self._outfollowers, data)
+        if self._outlog is not None:
+            self._outlog.write(data)
             
-    def process_stderr(self):
-        new = self.get_stderr().replace(b"\x00", b"")
-        self._errbuff += new
-        start = max(0, len(self._errbuff)-self.max_buff_size)
-        self._errbuff = self._errbuff[start:]
-        
-    def get_stdout(self):
-        self._outstream.flush()
-        self._outstream.seek(0)
-        r = self._outstream.read()
-        self._outstream.truncate(0)
-        return r
-    
-    def get_stderr(self):
-        self._errstream.flush()
-        self._errstream.seek(0)
-        r = self._errstream.read()
-        self._errstream.truncate(0)
-        return r
+    def feed_stderr(self, data):
+        """Appends output read from the stderr pipe, keeping the last `max_buff_size` bytes"""
+        with self._errbuff.lock:
+            self._errbuff.append(data)
+            self._push(self._errfollowers, data)
+        if self._errlog is not None:
+            self._errlog.write(data)
+            
+    def _push(self, followers, data):
+        closed = False
+        for follower in followers:
+            follower.push(data)
+            closed = closed or follower.closed
+        if closed:
+            followers[:] = [f for f in followers if not f.closed]
+            
+    def follow(self, follower, stream="stdout", lines=0):
+        """Streams the output to a `Follower` as it is produced.
+
+        Args:
+            follower (Follower): The follower
+            stream (str, optional): "stdout" or "stderr". Defaults to "stdout".
+            lines (int, optional): Previous lines to send first. Defaults to 0.
+        """
+        
+        if stream == "stdout":
+            buff, followers = self._outbuff, self._outfollowers
+        else:
+            buff, followers = self._errbuff, self._errfollowers
+        # * Holding the lock makes sure no output is missed or sent twice
+        # * between the backlog and the first live chunk
+        with buff.lock:
+            follower.push(b"".join(buff.tail_lines(lines)))
+            followers.append(follower)
+            
+    def close_followers(self):
+        for buff, followers in ((self._outbuff, self._outfollowers), 
+                                (self._errbuff, self._errfollowers)):
+            with buff.lock:
+                for follower in followers:
+                    follower.close()
+                followers.clear()
         
     def kill(self):
-        self._start = Time(0)
-        self._process.kill()
-        self._outstream.close()
-        self._errstream.close()
+        """Kills every replica (and their children) right away"""
+        with self._lock:
+            for replica in self._replicas:
+                replica.kill()
+                
+    def terminate(self):
+        """Sends the stop signal to every replica, without waiting for them.
+
+        Returns:
+            list: The (replica, child) pairs `reap` has to wait for
+        """
+        with self._lock:
+            return self._signal(self._replicas)
+                
+    def reap(self, deadline, children=None):
+        """Waits for the replicas to exit until `deadline` (a `time.monotonic()`
+        time), then kills the ones that are left.
+
+        Args:
+            children (list, optional): What `terminate` returned. Defaults to
+                the current child of every replica.
+        """
+        if children is None:
+            children = [(replica, replica.popen) for replica in self.replicas]
+        self._reap(children, deadline)
+                
+    def stop(self, timeout=None):
+        """Stops every replica gracefully (see `Process`).
+
+        Args:
+            timeout (float, optional): Seconds to wait before killing them.
+                Defaults to `stop_timeout`.
+        """
         
-    def update_cpu(self):
-        try:
-            self._cpu_usage = psutil.Process(self.pid).cpu_percent(0.5) / psutil.cpu_count()
-        except psutil.NoSuchProcess:
-            pass
+        deadline = time.monotonic() + (self.stop_timeout if timeout is None else timeout)
+        self.reap(deadline, self.terminate())
+            
+    def _signal(self, replicas):
+        # * Called with the lock held, the waiting is done without it so the
+        # * supervisor and other commands on the process aren't held up
+        for replica in replicas:
+            replica.send_signal(self.stop_signal)
+        return [(replica, replica.popen) for replica in replicas]
+
+    @staticmethod
+    def _reap(children, deadline):
+        for replica, popen in children:
+            replica.reap(deadline, popen)
         
     @property
     def command(self):
         return self._command
+    
+    @property
+    def dir(self):
+        return self._dir
         
     @property
     def active(self):
-        if self._process is None:
-            return False
-        return self._process.poll() is None
+        """True if any replica is running"""
+        return any(r.active for r in self._replicas)
+    
+    @property
+    def state(self):
+        if self.active:
+            return "active"
+        if self.restarting:
+            return "restarting"
+        return "crashed" if self.crashed else "stopped"
+    
+    @property
+    def restarting(self):
+        """True if no replica is running but some are waiting to be restarted"""
+        return not self.active and any(r.wanted for r in self._replicas)
     
     @property 
     def pid(self):
-        if self.active:
-            return self._process.pid
+        """PID of the first running replica, or -1"""
+        for replica in self._replicas:
+            pid = replica.pid
+            if pid != -1:
+                return pid
         return -1
     
     @property
-    def uptime(self):
-        if self.active:
-            return Time(datetime.datetime.now()-self._start)
-        else:
-            return Time(0)
+    def cpus(self):
+        """CPUs the running replicas are pinned to, or None if they aren't"""
+        cpus = set()
+        for replica in self._replicas:
+            if replica.active and replica.cpus:
+                cpus.update(replica.cpus)
+        return sorted(cpus) if cpus else None
     
-    def get_mem_usage(self):
-        if self.active:
-            return Size(psutil.Process(self.pid).memory_info().vms)
-        else:
-            return Size(0)
-    
-    def get_mem_perc(self):
-        if self.active:
-            return psutil.Process(self.pid).memory_percent("vms")
-        else:
-            return 0
+    @property
+    def pids(self):
+        """PIDs of all the running replicas"""
+        return [pid for pid in (r.pid for r in self._replicas) if pid != -1]
     
-    def get_cpu_perc(self):
-        if self.active:
-            if self._thread is None or not self._thread.is_alive():
-                self._thread = threading.Thread(target=self.update_cpu)
-                self._thread.setDaemon(True)
-                self._thread.start()
-            return self._cpu_usage
+    @property
+    def uptime(self):
+        """Time since the oldest running replica was started"""
+        starts = [r.start_time for r in self._replicas if r.active]
+        if starts:
+            return Time(datetime.datetime.now()-min(starts))
         else:
-            return 0
+            return Time(0)
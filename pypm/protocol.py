@@ -0,0 +1,248 @@
+import collections
+import itertools
+import socket
+import struct
+import threading
+
+from . import constants as const
+
+# * Every frame starts with the request ID and the payload length
+HEADER = struct.Struct("!II")
+MAX_FRAME_SIZE = 64 * 2**20
+# * Time a client may go without reading any of a response before it is disconnected
+SEND_TIMEOUT = 10
+
+
+def recv_exact(sock, size):
+    """Reads exactly `size` bytes from the socket.
+
+    Raises:
+        ConnectionError: If the connection is closed before enough data arrives
+    """
+
+    buff = bytearray()
+    while len(buff) < size:
+        data = sock.recv(min(size - len(buff), 65536))
+        if data == b"":
+            raise ConnectionError("Connection closed by peer")
+        buff += data
+    return bytes(buff)
+
+def sendmsg_all(sock, parts):
+    """Sends every buffer in `parts` without concatenating them first"""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    parts = [memoryview(p).cast("B") for p in parts if len(p) > 0]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts.pop(0))
+        if sent > 0:
+            parts[0] = parts[0][sent:]
+
+def send_parts(sock, parts):
+    """Sends a response made of several buffers through a socket or a `FrameReply`"""
+    if isinstance(sock, FrameReply):
+        sock.send_parts(parts)
+    else:
+        sendmsg_all(sock, parts)
+
+def encode_frame(request_id, payload):
+    return HEADER.pack(request_id, len(payload)) + payload
+
+def recv_frame(sock):
+    """Reads a single frame from the socket.
+
+    Returns:
+        tuple: The request ID and the payload
+    """
+
+    request_id, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError("Frame is too large")
+    return request_id, recv_exact(sock, length)
+
+def decode_frames(buff):
+    """Extracts every complete frame from the start of `buff`.
+
+    Args:
+        buff (bytearray): Received data, consumed frames are removed from it
+
+    Returns:
+        list: (request ID, payload) pairs
+    """
+
+    frames = []
+    while len(buff) >= HEADER.size:
+        request_id, length = HEADER.unpack_from(buff)
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError("Frame is too large")
+        end = HEADER.size + length
+        if len(buff) < end:
+            break
+        frames.append((request_id, bytes(buff[HEADER.size:end])))
+        del buff[:end]
+    return frames
+
+
+class FramedConnection:
+    """Server side state of a persistent, framed client connection.
+
+    At most `max_in_flight` of its requests are handled at once, the others
+    wait in `pending`, and the server stops reading from the connection while
+    it is `backlogged`. A client that pipelines requests without reading the
+    responses can thus only hold up a few handlers, and only until no part of
+    a response could be sent for `SEND_TIMEOUT` seconds, which closes the
+    connection.
+    """
+
+    def __init__(self, sock, max_in_flight=4):
+        self.sock = sock
+        self.sock.settimeout(SEND_TIMEOUT)
+        self.max_in_flight = max_in_flight
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.in_flight = 0
+        self.paused = False
+        self.closed = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def feed(self, data):
+        """Queues the requests completed by newly received data"""
+        self.buffer += data
+        frames = decode_frames(self.buffer)
+        with self._lock:
+            self.pending.extend(frames)
+
+    def take(self):
+        """Returns the pending requests that may be handled now, counting them as in flight"""
+        frames = []
+        with self._lock:
+            while self.pending and self.in_flight < self.max_in_flight and not self.closed:
+                frames.append(self.pending.popleft())
+                self.in_flight += 1
+        return frames
+
+    def done(self):
+        """Marks a request returned by `take` as handled"""
+        with self._lock:
+            self.in_flight -= 1
+            if self.closed and self.in_flight == 0:
+                self.sock.close()
+
+    @property
+    def backlogged(self):
+        return len(self.pending) >= self.max_in_flight
+
+    def close(self):
+        """Disconnects the client, the socket being closed once no request is in flight"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.clear()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            if self.in_flight == 0:
+                self.sock.close()
+
+    def send(self, request_id, payload):
+        self.send_parts(request_id, (payload,))
+            
+    def send_parts(self, request_id, parts):
+        length = sum(map(len, parts))
+        with self._write_lock:
+            try:
+                sendmsg_all(self.sock, [HEADER.pack(request_id, length)] + list(parts))
+            except OSError:
+                self.close()
+                raise
+
+
+class FrameReply:
+    """Socket-like object handed to command handlers for framed requests.
+
+    Whatever the handler sends is wrapped in a frame tagged with the ID of the
+    request it is answering.
+    """
+
+    def __init__(self, connection, request_id):
+        self._connection = connection
+        self._request_id = request_id
+        self.sent = False
+
+    def sendall(self, data):
+        self._connection.send(self._request_id, data)
+        self.sent = True
+        
+    def send_parts(self, parts):
+        self._connection.send_parts(self._request_id, parts)
+        self.sent = True
+
+
+class Connection:
+    """A persistent client connection to a pypm instance.
+
+    Requests are framed and tagged with an ID, so several of them can be
+    pipelined over the same connection. Instances are thread-safe.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._sock = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port))
+        self._sock.sendall(const.FRAME_CODE)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def request(self, command):
+        """Sends a command and waits for its response.
+
+        Args:
+            command (str): The command line, as understood by the server
+
+        Returns:
+            bytes: The response
+        """
+
+        return self.pipeline([command])[0]
+
+    def pipeline(self, commands):
+        """Sends several commands at once and waits for all responses.
+
+        Args:
+            commands (list): Command lines
+
+        Returns:
+            list: The responses, in the same order as the commands
+        """
+
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self.connect()
+                ids = [next(self._ids) for _ in commands]
+                self._sock.sendall(b"".join(
+                    encode_frame(i, c.encode("utf-8")) for i, c in zip(ids, commands)
+                ))
+                responses = {}
+                while len(responses) < len(ids):
+                    request_id, payload = recv_frame(self._sock)
+                    responses[request_id] = payload
+                return [responses[i] for i in ids]
+            except (ConnectionError, OSError):
+                # * Drop the connection so the next request reconnects
+                self.close()
+                raise
@@ -1,13 +1,34 @@
-import sys
-
 from .manager import ProcessManager
 
 
-def main(port=8080, log_dir=None, log_freq=1):
+def main(port=8080, log_dir=None, log_freq=1, sample_interval=1.0, **kwargs):
     if log_dir == "None":
         log_dir = None
-    pm = ProcessManager(port=port, log_dir=log_dir, log_frequency=log_freq)
+    pm = ProcessManager(port=port, 
+                        log_dir=log_dir, 
+                        log_frequency=log_freq, 
+                        sample_interval=sample_interval,
+                        **kwargs)
     pm.start()
     
+def main_from_args(args):
+    """Starts a process manager configured by the `init` command line arguments"""
+    main(args.port, 
+         args.logdir, 
+         args.logfreq, 
+         args.sampleint,
+         log_max_bytes=int(args.logsize * 2**20),
+         log_rotate_interval=args.logrotate * 3600 if args.logrotate > 0 else None,
+         log_backups=args.logbackups,
+         log_max_age=args.logmaxage * 86400 if args.logmaxage > 0 else None,
+         log_compression=None if args.logcompress == "none" else args.logcompress,
+         recent_window=args.recent * 60,
+         metrics_port=args.metricsport if args.metricsport > 0 else None,
+         metrics_host=args.metricshost,
+         parallelism=args.parallelism,
+         shutdown_timeout=args.shutdowntimeout)
+    
 if __name__ == "__main__":
-    main(int(sys.argv[1]), sys.argv[2], float(sys.argv[3]))
\ No newline at end of file
+    from .__main__ import get_start_parser
+    
+    main_from_args(get_start_parser().parse_known_args()[0])
@@ -0,0 +1,112 @@
+import os
+import re
+import socket
+import time
+
+
+class PortOpen:
+    def __init__(self, port, host="localhost"):
+        """Ready once a TCP connection to the port is accepted.
+
+        If the port is the process's base port, every replica is probed on
+        its own PORT (the base port plus its index). Any other port is shared
+        by the replicas, so it only tells that one of them is ready.
+        """
+        self.port = port
+        self.host = host
+
+    def __call__(self, process, replica=None):
+        port = self.port
+        if replica is not None and process.port == port:
+            port += replica.index
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            return sock.connect_ex((self.host, port)) == 0
+
+    def __str__(self):
+        return f"port:{self.host}:{self.port}"
+
+
+class LogMatch:
+    def __init__(self, pattern, stream="stdout"):
+        """Ready once a line the replica wrote since it was spawned matches a
+        regular expression (the "[N] " prefix of clustered output excluded)"""
+        self.pattern = re.compile(pattern.encode(), re.MULTILINE)
+        self.stream = stream
+
+    def __call__(self, process, replica):
+        buff = process.stdout_buffer if self.stream == "stdout" else process.stderr_buffer
+        with buff.lock:
+            data = b"".join(buff.range(replica.output_start[self.stream], buff.end))
+        if process.instances > 1:
+            prefix = re.escape(b"[%d] " % replica.index)
+            data = b"".join(re.findall(b"^" + prefix + b"(.*\n)", data, re.MULTILINE))
+        return self.pattern.search(data) is not None
+
+    def __str__(self):
+        return f"{'log' if self.stream == 'stdout' else 'stderr'}:{self.pattern.pattern.decode()}"
+
+
+class FileExists:
+    def __init__(self, path):
+        """Ready once the file exists (relative paths are relative to the process's directory)"""
+        self.path = path
+
+    def __call__(self, process, replica=None):
+        return os.path.exists(os.path.join(process.dir, self.path))
+
+    def __str__(self):
+        return f"file:{self.path}"
+
+
+def parse_check(spec):
+    """Creates a readiness check from its description.
+
+    Args:
+        spec (str): "port:PORT", "port:HOST:PORT", "log:REGEX", "stderr:REGEX" or "file:PATH"
+
+    Raises:
+        ValueError: If the description is invalid
+    """
+
+    kind, sep, arg = spec.partition(":")
+    if not sep or not arg:
+        raise ValueError(f"Invalid readiness check '{spec}'")
+    if kind == "port":
+        host, _, port = arg.rpartition(":")
+        if not port.isdigit():
+            raise ValueError(f"Invalid port '{port}'")
+        return PortOpen(int(port), host or "localhost")
+    if kind in ("log", "stderr"):
+        try:
+            return LogMatch(arg, "stdout" if kind == "log" else "stderr")
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression '{arg}': {e}")
+    if kind == "file":
+        return FileExists(arg)
+    raise ValueError(f"Unknown readiness check '{kind}'")
+
+def wait_ready(process, check, timeout=30, interval=0.1, replicas=None):
+    """Waits until every replica of a started process passes its readiness check.
+
+    Args:
+        replicas (list, optional): Only wait for these replicas. Defaults to
+            all of them.
+
+    Raises:
+        OSError: If one of the replicas exits before becoming ready
+        TimeoutError: If they aren't all ready after `timeout` seconds
+    """
+
+    replicas = process.replicas if replicas is None else replicas
+    deadline = time.monotonic() + timeout
+    pending = list(replicas)
+    while True:
+        pending = [r for r in pending if not check(process, r)]
+        if not pending:
+            return
+        if not all(r.active for r in replicas):
+            raise OSError("Process exited before becoming ready")
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Process wasn't ready after {timeout}s ({check})")
+        time.sleep(interval)
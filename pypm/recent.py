@@ -0,0 +1,97 @@
+import bisect
+import threading
+from array import array
+
+# * Every slot holds a timestamp, the CPU usage, the RSS and the VMS
+FIELDS = ("times", "cpu", "rss", "vms")
+SLOT_SIZE = 8 * len(FIELDS)
+
+
+class Series:
+    __slots__ = ("capacity", "count", "index", "times", "cpu", "rss", "vms")
+
+    def __init__(self, capacity):
+        """The last `capacity` samples of a process, in preallocated rings.
+
+        Args:
+            capacity (int): Number of samples kept
+        """
+
+        self.capacity = capacity
+        self.count = 0
+        self.index = 0
+        for field in FIELDS:
+            setattr(self, field, array("d", bytes(8 * capacity)))
+
+    def append(self, timestamp, cpu, rss, vms):
+        i = self.index
+        self.times[i] = timestamp
+        self.cpu[i] = cpu
+        self.rss[i] = rss
+        self.vms[i] = vms
+        self.index = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _ordered(self, ring):
+        if self.count < self.capacity:
+            return ring[:self.count].tolist()
+        return ring[self.index:].tolist() + ring[:self.index].tolist()
+
+    def read(self, since=None):
+        """Returns the samples taken after `since` (UNIX time), oldest first.
+
+        Returns:
+            dict: Maps "times", "cpu", "rss" and "vms" to lists of values
+        """
+
+        series = {field: self._ordered(getattr(self, field)) for field in FIELDS}
+        if since is not None:
+            first = bisect.bisect_right(series["times"], since)
+            for field in FIELDS:
+                del series[field][:first]
+        return series
+
+
+class RecentMetrics:
+    def __init__(self, window, period):
+        """Keeps the samples of the last `window` seconds of every process in memory.
+
+        Each process gets a `Series` of fixed capacity that is allocated once,
+        when its first sample is recorded, and never grows. It takes
+        `SLOT_SIZE` (32) bytes per sample plus a few hundred bytes of object
+        overhead, e.g. ~10KB for 10 minutes of samples taken every 2 seconds.
+
+        Args:
+            window (float): Seconds of history kept
+            period (float): Seconds between samples
+        """
+
+        self.window = window
+        self.capacity = max(1, int(window / period))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    @property
+    def footprint(self):
+        """Bytes taken by the samples of a single process"""
+        return SLOT_SIZE * self.capacity
+
+    def record(self, name, timestamp, sample):
+        """Stores a `Sample` of a process, taken by the tick at `timestamp`"""
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = Series(self.capacity)
+            series.append(timestamp, sample.cpu, sample.rss, sample.vms)
+
+    def remove(self, name):
+        with self._lock:
+            self._series.pop(name, None)
+
+    def get(self, name, since=None):
+        """Returns the recent samples of a process, as in `Series.read`"""
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                return {field: [] for field in FIELDS}
+            return series.read(since)
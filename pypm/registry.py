@@ -0,0 +1,59 @@
+import threading
+
+
+class ProcessRegistry:
+    def __init__(self):
+        """The set of managed processes, indexed by name.
+
+        Lookups, insertions, removals and logging flag checks are all O(1),
+        and iteration follows insertion order. Iterating works on a copy, so
+        the registry can be changed by other threads in the meantime.
+        """
+
+        self._processes = {}
+        self._log_cpu = set()
+        self._log_memory = set()
+        self._lock = threading.RLock()
+
+    def add(self, process, log_cpu=False, log_memory=False):
+        """Adds a process.
+
+        Returns:
+            bool: True if there wasn't a process with the same name already
+        """
+
+        with self._lock:
+            if process.name in self._processes:
+                return False
+            self._processes[process.name] = process
+            if log_cpu:
+                self._log_cpu.add(process.name)
+            if log_memory:
+                self._log_memory.add(process.name)
+            return True
+
+    def remove(self, process):
+        with self._lock:
+            del self._processes[process.name]
+            self._log_cpu.discard(process.name)
+            self._log_memory.discard(process.name)
+
+    def get(self, name):
+        """Returns the process with the given name, or None"""
+        return self._processes.get(name)
+
+    def logs_cpu(self, process):
+        return process.name in self._log_cpu
+
+    def logs_memory(self, process):
+        return process.name in self._log_memory
+
+    def __contains__(self, process):
+        return process.name in self._processes
+
+    def __len__(self):
+        return len(self._processes)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._processes.values()))
@@ -0,0 +1,107 @@
+import threading
+import time
+
+import psutil
+
+
+class Sample:
+    __slots__ = ("pid", "cpu", "rss", "vms", "mem_perc", "time")
+
+    def __init__(self, pid=-1, cpu=0, rss=0, vms=0, mem_perc=0, time=0):
+        """Resource usage of a process at a given instant
+
+        Args:
+            pid (int): PID of the sampled process
+            cpu (float): CPU usage (percentage of the whole machine)
+            rss (int): Resident memory, in bytes
+            vms (int): Virtual memory, in bytes
+            mem_perc (float): Virtual memory as a percentage of the total memory
+            time (float): Timestamp of the sample
+        """
+
+        self.pid = pid
+        self.cpu = cpu
+        self.rss = rss
+        self.vms = vms
+        self.mem_perc = mem_perc
+        self.time = time
+
+
+EMPTY_SAMPLE = Sample()
+
+
+class Sampler:
+    def __init__(self, processes, interval=1.0):
+        """Samples the resource usage of every managed process from a single thread.
+
+        The latest sample of each process is kept in a table, so reading it
+        never touches psutil. The replicas of a process are summed up into a
+        single sample. The psutil handles are cached between passes,
+        which is also what makes non-blocking CPU measurements possible.
+
+        Args:
+            processes (iterable): The processes to sample, iterated on every pass
+            interval (float, optional): Seconds between passes. Defaults to 1.0.
+        """
+
+        self.interval = interval
+        self._processes = processes
+        self._handles = {}
+        self._samples = {}
+        self._cpu_count = psutil.cpu_count() or 1
+        self._total_memory = psutil.virtual_memory().total
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pypm-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get(self, process):
+        """Returns the latest sample of a process (all zeros if it isn't running)"""
+        sample = self._samples.get(process.name, EMPTY_SAMPLE)
+        if sample.pid != process.pid:
+            return EMPTY_SAMPLE
+        return sample
+
+    def sample(self):
+        """Samples every process once"""
+        samples = {}
+        handles = {}
+        for process in self._processes:
+            pids = process.pids
+            if not pids:
+                continue
+            cpu = rss = vms = 0
+            for pid in pids:
+                handle = self._handles.get(pid)
+                try:
+                    if handle is None:
+                        handle = psutil.Process(pid)
+                    with handle.oneshot():
+                        cpu += handle.cpu_percent(None) / self._cpu_count
+                        memory = handle.memory_info()
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+                rss += memory.rss
+                vms += memory.vms
+                handles[pid] = handle
+            samples[process.name] = Sample(pids[0], cpu, rss, vms,
+                                           100 * vms / self._total_memory,
+                                           time.time())
+        # * Swapping the tables is atomic, readers never see a partial pass
+        self._handles = handles
+        self._samples = samples
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.sample()
+            self._stop.wait(max(0, self.interval - (time.time() - start)))
@@ -0,0 +1,254 @@
+import collections
+import heapq
+import logging
+import os
+import random
+import selectors
+import signal
+import socket
+import threading
+import time
+
+from .process import has_exited
+
+POLICIES = ("always", "on-failure", "never")
+
+
+class Supervisor:
+    def __init__(self, respawn, backoff=1, max_backoff=60, window=60):
+        """Tracks the exit of every spawned replica, and restarts those that exit
+        on their own following their process's policy.
+
+        Exits are noticed through a pidfd per replica on Linux, all waited on
+        by a single selector thread. Elsewhere, a SIGCHLD handler wakes that
+        thread up through a self-pipe, and only then are the children reaped
+        (or, if the handler can't be installed because the manager doesn't run
+        in the main thread, a thread blocks in `wait()` per replica). Either
+        way, replicas are marked as exited as soon as they are reaped, so
+        checking whether they run never costs a system call.
+        
+        A replica that is restarted again and again waits
+        `backoff * 2**failures` seconds (at most `max_backoff`, with jitter)
+        between attempts, and a process whose replicas were restarted
+        `max_restarts` times within `window` seconds is considered
+        crash-looping and isn't restarted anymore.
+
+        Args:
+            respawn (callable): Called with a process and one of its replicas to
+                start the replica again
+            backoff (float, optional): First restart delay, in seconds. Defaults to 1.
+            max_backoff (float, optional): Maximum restart delay. Defaults to 60.
+            window (float, optional): Crash-loop detection window, in seconds.
+                A replica that ran for longer is restarted without delay.
+                Defaults to 60.
+        """
+
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.window = window
+        self._respawn = respawn
+        self._selector = None
+        self._pending = []
+        self._children = {}
+        self._sigchld = False
+        self._previous_handler = None
+        self._timers = []
+        self._failures = {}
+        self._history = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = None, None
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        self._stop = False
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        if not hasattr(os, "pidfd_open") and hasattr(signal, "SIGCHLD"):
+            try:
+                self._previous_handler = signal.signal(signal.SIGCHLD, self._on_sigchld)
+                self._sigchld = True
+            except ValueError:
+                # * Not in the main thread
+                self._sigchld = False
+        self._thread = threading.Thread(target=self._run, name="pypm-supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+        # * Replicas spawned before the supervisor was started
+        self._wake()
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._wake()
+            self._thread.join()
+            self._thread = None
+        if self._sigchld:
+            try:
+                signal.signal(signal.SIGCHLD, self._previous_handler or signal.SIG_DFL)
+            except ValueError:
+                pass
+            self._sigchld = False
+
+    def watch(self, process, replica):
+        """Starts tracking a freshly spawned replica.
+
+        From then on the replica's `active` state is only updated when the
+        supervisor reaps it (or when it is killed).
+        """
+        
+        popen = replica.popen
+        replica.watched = True
+        fd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                fd = os.pidfd_open(popen.pid)
+            except ProcessLookupError:
+                # * It already exited and was reaped
+                pass
+            except OSError:
+                fd = -1
+        elif not self._sigchld:
+            fd = -1
+        if fd == -1:
+            thread = threading.Thread(target=self._wait, args=(process, replica, popen))
+            thread.daemon = True
+            thread.start()
+            return
+        with self._lock:
+            self._pending.append((process, replica, popen, fd))
+        self._wake()
+
+    def reset(self, process):
+        """Forgets the restart history of a process (e.g. when it is started by hand)"""
+        with self._lock:
+            self._history.pop(process.name, None)
+            for key in [k for k in self._failures if k[0] == process.name]:
+                del self._failures[key]
+
+    def _wake(self):
+        if self._wake_w is None:
+            return
+        try:
+            self._wake_w.send(b"\x00")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _on_sigchld(self, signum, frame):
+        self._wake()
+
+    def _wait(self, process, replica, popen):
+        if hasattr(os, "waitid"):
+            # * Left unreaped, so `collect` can still kill its group
+            try:
+                os.waitid(os.P_PID, popen.pid, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                pass
+        else:
+            popen.wait()
+        replica.collect(popen)
+        self._exited(process, replica, popen)
+
+    def _run(self):
+        try:
+            while not self._stop:
+                with self._lock:
+                    timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+                for key, _ in self._selector.select(None if timeout is None else max(0, timeout)):
+                    if key.fileobj is self._wake_r:
+                        self._process_pending()
+                        if self._sigchld:
+                            self._reap()
+                    else:
+                        self._selector.unregister(key.fileobj)
+                        os.close(key.fileobj)
+                        process, replica, popen = key.data
+                        replica.collect(popen)
+                        self._exited(process, replica, popen)
+                self._run_timers()
+        finally:
+            for key in list(self._selector.get_map().values()):
+                if key.fileobj is not self._wake_r:
+                    os.close(key.fileobj)
+            self._wake_r.close()
+            self._selector.close()
+            self._wake_w.close()
+
+    def _process_pending(self):
+        try:
+            while self._wake_r.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for process, replica, popen, fd in pending:
+            if fd is not None:
+                self._selector.register(fd, selectors.EVENT_READ, (process, replica, popen))
+            elif self._sigchld:
+                self._children[id(popen)] = (process, replica, popen)
+            else:
+                replica.collect(popen)
+                self._exited(process, replica, popen)
+                
+    def _reap(self):
+        for key, (process, replica, popen) in list(self._children.items()):
+            if has_exited(popen):
+                del self._children[key]
+                replica.collect(popen)
+                self._exited(process, replica, popen)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers))
+        for _, _, process, replica, popen in due:
+            # * Skip it if the replica was started or stopped by hand meanwhile
+            # * (checked again by `Process.respawn`, under the process lock)
+            if replica.popen is not popen or not replica.wanted:
+                continue
+            try:
+                self._respawn(process, replica)
+            except Exception:
+                process.crashed = True
+                logging.exception(f"Couldn't restart process '{process.name}'")
+
+    def _exited(self, process, replica, popen):
+        code = popen.returncode
+        # * Under the replica's lock, which is never held for long (unlike
+        # * the process lock), so a replica being spawned or stopped meanwhile
+        # * is seen either before or after
+        with replica.lock:
+            if replica.popen is not popen or not replica.wanted:
+                # * Killed on purpose, or already replaced
+                return
+            process.last_exit_code = code
+            if process.restart_policy == "never" or (process.restart_policy == "on-failure" and code == 0):
+                replica.wanted = False
+                return
+            now = time.monotonic()
+            key = (process.name, replica.index)
+            with self._lock:
+                history = self._history[process.name]
+                while history and history[0] < now - self.window:
+                    history.popleft()
+                if len(history) >= process.max_restarts:
+                    replica.wanted = False
+                    process.crashed = True
+                    logging.error(f"Process '{process.name}' is crash-looping, giving up on restarting it")
+                    return
+                history.append(now)
+                uptime = time.time() - replica.start_time.timestamp()
+                failures = 0 if uptime >= self.window else self._failures.get(key, 0)
+                self._failures[key] = failures + 1
+                delay = min(self.max_backoff, self.backoff * 2 ** failures) if failures > 0 else 0
+                delay = random.uniform(delay / 2, delay)
+                heapq.heappush(self._timers, (now + delay, id(popen), process, replica, popen))
+        logging.warning(f"Process '{process.name}' exited with code {code}, "
+                        f"restarting it in {delay:.1f}s")
+        self._wake()
@@ -70,6 +70,8 @@ class Time:
         
     @property
     def seconds(self):
+        if isinstance(self._value, (int, float)):
+            return self._value
         return self._value.total_seconds()
     
     @property 
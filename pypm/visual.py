@@ -1,28 +1,130 @@
-import struct
+import os
 from math import log2
 
 import matplotlib.pyplot as plt
+import numpy as np
 
+from . import metrics
+
+# * Same layout as `metrics.RECORD`
+RECORD_DTYPE = np.dtype([("kind", "u1"), ("pad", "V7"), ("time", "<f8"), ("value", "<f8")])
+assert RECORD_DTYPE.itemsize == metrics.RECORD.size
+
+
+def map_metrics(file):
+    """Memory-maps a metrics file written by `metrics.MetricWriter`.
+
+    Nothing but the header is read: the records are a zero-copy view of the
+    file, so only the pages that are actually used get loaded.
+
+    Returns:
+        tuple: The header (as returned by `metrics.unpack_header`) and a
+            structured array of the records, with "kind", "time" and "value"
+            fields
+    """
+
+    with open(file, "rb") as f:
+        header = metrics.unpack_header(f.read(metrics.HEADER.size))
+    count = (os.path.getsize(file) - metrics.HEADER.size) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return header, np.empty(0, dtype=RECORD_DTYPE)
+    records = np.memmap(file, dtype=RECORD_DTYPE, mode="r",
+                        offset=metrics.HEADER.size, shape=(count,))
+    return header, records
+
+def time_slice(records, start=None, end=None):
+    """Returns the records with a timestamp in [start, end), as a view.
+
+    The bounds are found with a binary search, which assumes the timestamps
+    are increasing (i.e. the clock wasn't set back while logging).
+    """
+
+    times = records["time"]
+    first = 0 if start is None else np.searchsorted(times, start, side="left")
+    last = len(records) if end is None else np.searchsorted(times, end, side="left")
+    return records[first:last]
+
+def read_metrics(file, start=None, end=None):
+    """Loads a metrics file written by `metrics.MetricWriter`.
+
+    Args:
+        file (str): The file
+        start (float, optional): Only load records from this UNIX time on
+        end (float, optional): Only load records before this UNIX time
+
+    Returns:
+        dict: The header fields ("version", "metric", "unit", "period") and
+            "times"/"values" arrays of the samples, "restarts" as (time, PID)
+            pairs and "periods" as (time, sampling period) pairs
+    """
+
+    result, records = map_metrics(file)
+    records = time_slice(records, start, end)
+    kinds = records["kind"]
+    samples = records[kinds == metrics.SAMPLE]
+    restarts = records[kinds == metrics.RESTART]
+    periods = records[kinds == metrics.PERIOD]
+    result.update(
+        times=samples["time"],
+        values=samples["value"],
+        restarts=[(t, int(pid)) for t, pid in zip(restarts["time"].tolist(), restarts["value"].tolist())],
+        periods=list(zip(periods["time"].tolist(), periods["value"].tolist()))
+    )
+    return result
+
+def load_history(file, start=None, end=None, points=1000, stats=("mean",), method="buckets"):
+    """Loads a downsampled time range of a metrics file.
+
+    Same as `metrics.query`, with the range defaulting to the whole file.
+
+    Args:
+        file (str): The metrics file
+        start (float, optional): Start of the range (UNIX time). Defaults to
+            the first record.
+        end (float, optional): End of the range (UNIX time). Defaults to the
+            last record.
+        points (int, optional): Maximum number of points. Defaults to 1000.
+        stats (tuple, optional): Statistics of every bucket, see
+            `downsample.aggregate`. Defaults to ("mean",).
+        method (str, optional): "buckets", or "lttb" to pick representative
+            samples instead (`stats` is then ignored). Defaults to "buckets".
+
+    Returns:
+        tuple: The times, and a dict mapping each statistic (or "value", for
+            LTTB) to its values
+    """
+
+    header, records = map_metrics(file)
+    if start is None:
+        start = records["time"][0] if len(records) > 0 else 0
+    if end is None:
+        end = records["time"][-1] + header["period"] if len(records) > 0 else start
+    return metrics.query(file, float(start), float(end), points, stats, method)
 
 def get_data(file):
+    """Returns the values in a metrics file, or in a legacy raw `_log_cpu`/`_log_mem` file"""
     with open(file, "rb") as f:
-        content = f.read()
-        data = struct.unpack(f"{len(content)//8}d", content)
-    return data
+        magic = f.read(len(metrics.MAGIC))
+    if magic == metrics.MAGIC:
+        return read_metrics(file)["values"]
+    count = os.path.getsize(file) // 8
+    if count == 0:
+        return np.empty(0)
+    return np.memmap(file, dtype="=f8", mode="r", shape=(count,))
 
 def plot_mem_data(data, title="Memory Usage", xlabel="Time", ylabel="Usage"):
     units = ["B", "KB", "MB", "GB"]
+    data = np.asarray(data)
     if len(data) == 0:
         avg = 0
     else:
-        avg = sum(data)/len(data)
-    if avg == 0:
+        avg = data.mean()
+    if avg <= 0:
         i = 0
     else:
-        i = int(min(log2(avg)/10, 3))
+        i = int(max(0, min(log2(avg)/10, 3)))
         
-    data = list(map(lambda x: x/2**(i*10), data))
-    plt.plot(data)
+    plt.plot(data / 2**(i*10))
     plt.title(title)
     plt.xlabel(xlabel)
     plt.ylabel(f"{ylabel} ({units[i]})")